@@ -1,16 +1,36 @@
 import os
 import sys
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_file, Response
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_file, Response, stream_with_context, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 import google.generativeai as genai
 import json
 import re
+import random
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit, quote
+import http.cookiejar
 import time
 import csv
 import io
+import threading
+import hashlib
+import shutil
+import signal
+import subprocess
+import sqlite3
+import tempfile
+import contextlib
+import functools
+import copy
+import secrets
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 # Conditional imports for optional dependencies - REMOVED FOR VERCEL
 # All optional dependencies removed to prevent import crashes
 HAS_PANDAS = False
@@ -26,6 +46,12 @@ HAS_REPORTLAB = False
 def get_easyocr_reader():
     return None
 
+# rlimits for the local code runner are POSIX-only
+try:
+    import resource
+except ImportError:
+    resource = None
+
 from collections import Counter
 from datetime import datetime
 
@@ -61,6 +87,9 @@ if database_url and database_url.startswith('postgres://'):
 elif database_url and database_url.startswith('postgresql://'):
     # Already in correct format for NeonDB
     app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+elif database_url and database_url.startswith('sqlite:'):
+    # Explicit SQLite file (relative paths resolve inside the instance folder)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///unittest.db'
 
@@ -141,8 +170,272 @@ def configure_google_ai():
         traceback.print_exc(file=sys.stderr)
         # Continue without AI features if key is invalid
 
-# Configure immediately but with error handling
-configure_google_ai()
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-2.0-flash')
+
+# ---------------------------------------------------------------------------
+# Shared Gemini client
+#
+# One AIClient per process configures the SDK on first use and reuses model instances.
+# Calls are capped by a semaphore (AI_MAX_IN_FLIGHT) and paced by a token bucket holding
+# this process's share of AI_RATE_LIMIT_RPM, so a burst (e.g. a whole class submitting at
+# once) queues locally instead of hitting 429s. After a 429 every caller waits out the
+# cooldown together. AI_STUB_MODEL=true swaps in an offline stub for tests and load runs.
+# ---------------------------------------------------------------------------
+AI_MAX_IN_FLIGHT = int(os.environ.get('AI_MAX_IN_FLIGHT', '8'))
+AI_RATE_LIMIT_RPM = float(os.environ.get('AI_RATE_LIMIT_RPM', '0'))  # whole deployment; 0 = unlimited
+AI_RATE_LIMIT_WORKERS = int(os.environ.get('AI_RATE_LIMIT_WORKERS', os.environ.get('WEB_CONCURRENCY', '1')))
+AI_STUB_MODEL = os.environ.get('AI_STUB_MODEL', 'false').lower() == 'true'
+AI_STUB_LATENCY = float(os.environ.get('AI_STUB_LATENCY', '0'))
+
+class TokenBucket:
+    """Blocking token bucket refilled at rate tokens per second, holding up to capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_for = (1 - self.tokens) / self.rate
+            time.sleep(wait_for)
+
+class AIClient:
+    """Process-wide Gemini access: cached models, in-flight cap, rate limiting and 429 cooldown"""
+
+    def __init__(self, max_in_flight=AI_MAX_IN_FLIGHT, requests_per_minute=AI_RATE_LIMIT_RPM,
+                 workers=AI_RATE_LIMIT_WORKERS, model_factory=None):
+        self._lock = threading.Lock()
+        self._models = {}
+        self._model_factory = model_factory
+        self._slots = threading.BoundedSemaphore(max(1, max_in_flight))
+        rate = requests_per_minute / max(1, workers) / 60.0
+        self._bucket = TokenBucket(rate, capacity=rate * 10) if rate > 0 else None
+        self._cooldown_until = 0.0
+
+    def use_model_factory(self, factory):
+        """Swap the model class (e.g. StubGenerativeModel in tests); cached models are dropped"""
+        with self._lock:
+            self._model_factory = factory
+            self._models = {}
+
+    def model(self, name=None):
+        name = name or GEMINI_MODEL
+        with self._lock:
+            model = self._models.get(name)
+            if model is None:
+                factory = self._model_factory
+                if factory is None:
+                    configure_google_ai()  # Ensure Google AI is configured
+                    factory = genai.GenerativeModel
+                model = self._models[name] = factory(name)
+            return model
+
+    def cooldown(self, seconds):
+        """Hold back every caller in this process for the given number of seconds"""
+        with self._lock:
+            self._cooldown_until = max(self._cooldown_until, time.monotonic() + seconds)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Wait out any cooldown and the rate limit, then hold one of the in-flight slots"""
+        delay = self._cooldown_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if self._bucket:
+            self._bucket.acquire()
+        with self._slots:
+            yield
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+class StubGenerativeModel:
+    """
+    Offline stand-in for genai.GenerativeModel: answers the quiz, grading and learning prompts
+    this app sends with well-formed canned output after AI_STUB_LATENCY seconds.
+    """
+
+    def __init__(self, model_name=None, **kwargs):
+        self.model_name = model_name
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        if AI_STUB_LATENCY:
+            time.sleep(AI_STUB_LATENCY)
+        text = self.respond(prompt)
+        if stream:
+            return [StubResponse(text[i:i + 64]) for i in range(0, len(text), 64)]
+        return StubResponse(text)
+
+    @staticmethod
+    def respond(prompt):
+        items = re.findall(r'^\s*Item (\d+):', prompt, re.MULTILINE)
+        if items:
+            return json.dumps([{'item': int(n), 'score': 0.5} for n in items])
+        if 'Evaluate this student' in prompt:
+            return '0.5'
+
+        count_match = re.search(r'exactly (\d+)', prompt)
+        count = int(count_match.group(1)) if count_match else 5
+        tag = random.randint(1000, 9999)  # Keeps questions distinct across calls for dedupe
+        if 'multiple-choice' in prompt:
+            return json.dumps([{'question': f"Stub MCQ {tag}-{i + 1}",
+                                'options': ['A. one', 'B. two', 'C. three', 'D. four'],
+                                'answer': 'A', 'type': 'mcq'} for i in range(count)])
+        if 'coding programming problems' in prompt:
+            return json.dumps([{'question': f"Stub problem {tag}-{i + 1}: print the input back.", 'type': 'coding',
+                                'sample_input': '1', 'sample_output': '1',
+                                'test_cases': [{'input': '1', 'expected_output': '1', 'is_hidden': False}],
+                                'starter_code': {'python': 'print(input())'}} for i in range(count)])
+        if 'subjective questions' in prompt:
+            return json.dumps([{'question': f"Stub question {tag}-{i + 1}", 'answer': 'Stub answer',
+                                'type': 'subjective', 'marks': 10} for i in range(count)])
+        return ("## OVERVIEW\nStub overview.\n\n## KEY CONCEPTS\n• Stub concept\n\n"
+                "## LEARNING OBJECTIVES\n✓ Stub objective\n\n## STUDY APPROACH\nStub approach.\n\n"
+                "## COMMON MISCONCEPTIONS\n⚠️ Stub misconception\n\n## NEXT STEPS\nStub next steps.")
+
+ai_client = AIClient(model_factory=StubGenerativeModel if AI_STUB_MODEL else None)
+
+# ---------------------------------------------------------------------------
+# AI call instrumentation
+#
+# Every Gemini request goes through ai_generate(), which records latency, token usage,
+# retries and errors per operation. Totals are served in Prometheus text format at
+# /metrics, and each response carries a Server-Timing header with its AI time.
+# ---------------------------------------------------------------------------
+AI_CALL_RETRIES = int(os.environ.get('AI_CALL_RETRIES', '2'))
+AI_RETRY_BASE_DELAY = float(os.environ.get('AI_RETRY_BASE_DELAY', '1'))
+AI_RETRY_MAX_DELAY = float(os.environ.get('AI_RETRY_MAX_DELAY', '30'))
+AI_LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+
+try:
+    from google.api_core import exceptions as google_exceptions
+    AI_TRANSIENT_ERRORS = (google_exceptions.TooManyRequests, google_exceptions.ServiceUnavailable,
+                           google_exceptions.DeadlineExceeded, google_exceptions.InternalServerError)
+except ImportError:
+    AI_TRANSIENT_ERRORS = ()
+
+class AIMetrics:
+    """Thread-safe call counters, token totals and latency histograms, keyed by operation"""
+
+    def __init__(self, buckets=AI_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._latency = {}  # operation -> {'buckets': [...], 'sum': float, 'count': int}
+        self._calls = Counter()  # (operation, outcome)
+        self._tokens = Counter()  # (operation, kind)
+        self._retries = Counter()  # operation
+        self._errors = Counter()  # (operation, error type)
+
+    def observe(self, operation, seconds, error=None, prompt_tokens=0, response_tokens=0):
+        with self._lock:
+            hist = self._latency.setdefault(operation, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist['buckets'][i] += 1
+            hist['sum'] += seconds
+            hist['count'] += 1
+            self._calls[(operation, 'error' if error else 'success')] += 1
+            if error:
+                self._errors[(operation, type(error).__name__)] += 1
+            self._tokens[(operation, 'prompt')] += prompt_tokens
+            self._tokens[(operation, 'response')] += response_tokens
+
+    def retried(self, operation):
+        with self._lock:
+            self._retries[operation] += 1
+
+    def render(self):
+        """Prometheus text exposition of everything recorded so far"""
+        with self._lock:
+            lines = ['# HELP ai_request_duration_seconds Latency of Gemini generate_content calls.',
+                     '# TYPE ai_request_duration_seconds histogram']
+            for operation, hist in sorted(self._latency.items()):
+                for bound, count in zip(self.buckets, hist['buckets']):
+                    lines.append(f'ai_request_duration_seconds_bucket{{operation="{operation}",le="{bound}"}} {count}')
+                lines.append(f'ai_request_duration_seconds_bucket{{operation="{operation}",le="+Inf"}} {hist["count"]}')
+                lines.append(f'ai_request_duration_seconds_sum{{operation="{operation}"}} {hist["sum"]:.6f}')
+                lines.append(f'ai_request_duration_seconds_count{{operation="{operation}"}} {hist["count"]}')
+            lines += ['# HELP ai_requests_total Gemini calls by outcome.', '# TYPE ai_requests_total counter']
+            lines += [f'ai_requests_total{{operation="{op}",outcome="{outcome}"}} {n}'
+                      for (op, outcome), n in sorted(self._calls.items())]
+            lines += ['# HELP ai_tokens_total Prompt and response tokens reported by Gemini.', '# TYPE ai_tokens_total counter']
+            lines += [f'ai_tokens_total{{operation="{op}",kind="{kind}"}} {n}'
+                      for (op, kind), n in sorted(self._tokens.items())]
+            lines += ['# HELP ai_retries_total Gemini calls retried after a transient error.', '# TYPE ai_retries_total counter']
+            lines += [f'ai_retries_total{{operation="{op}"}} {n}' for op, n in sorted(self._retries.items())]
+            lines += ['# HELP ai_errors_total Failed Gemini calls by exception type.', '# TYPE ai_errors_total counter']
+            lines += [f'ai_errors_total{{operation="{op}",error="{err}"}} {n}'
+                      for (op, err), n in sorted(self._errors.items())]
+        return '\n'.join(lines) + '\n'
+
+ai_metrics = AIMetrics()
+
+def record_ai_call(operation, seconds, response=None, error=None):
+    usage = getattr(response, 'usage_metadata', None)
+    ai_metrics.observe(operation, seconds, error=error,
+                       prompt_tokens=getattr(usage, 'prompt_token_count', 0) or 0,
+                       response_tokens=getattr(usage, 'candidates_token_count', 0) or 0)
+    # Only calls made on the request thread count towards its Server-Timing header
+    if has_request_context():
+        g.ai_seconds = g.get('ai_seconds', 0.0) + seconds
+        g.ai_calls = g.get('ai_calls', 0) + 1
+
+def _instrumented_stream(operation, response, started):
+    last_chunk = None
+    error = None
+    try:
+        for chunk in response:
+            last_chunk = chunk  # usage_metadata for the whole call arrives on the final chunk
+            yield chunk
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        record_ai_call(operation, time.perf_counter() - started, response=last_chunk, error=error)
+
+def ai_generate(operation, prompt, stream=False):
+    """
+    Call Gemini generate_content for the named operation through the shared client, recording
+    metrics. Transient errors are retried up to AI_CALL_RETRIES times with jittered exponential
+    backoff; a 429 puts the whole process into cooldown. Streamed calls are timed until fully read.
+    """
+    model = ai_client.model()
+    attempt = 0
+    while True:
+        with ai_client.slot():
+            started = time.perf_counter()
+            try:
+                response = model.generate_content(prompt, stream=stream)
+                break
+            except Exception as e:
+                error = e
+                elapsed = time.perf_counter() - started
+        record_ai_call(operation, elapsed, error=error)
+        if not (isinstance(error, AI_TRANSIENT_ERRORS) and attempt < AI_CALL_RETRIES):
+            raise error
+        delay = min(AI_RETRY_MAX_DELAY, AI_RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+        attempt += 1
+        ai_metrics.retried(operation)
+        if isinstance(error, google_exceptions.TooManyRequests):
+            ai_client.cooldown(delay)  # Back off every caller, not just this one
+        else:
+            time.sleep(delay)
+    if stream:
+        return _instrumented_stream(operation, response, started)
+    record_ai_call(operation, time.perf_counter() - started, response=response)
+    return response
 
 # Database Models
 class User(UserMixin, db.Model):
@@ -159,6 +452,7 @@ class Progress(db.Model):
     topic = db.Column(db.String(100), nullable=False)
     bloom_level = db.Column(db.Integer, default=1)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index('uq_progress_user_topic', 'user_id', 'topic', unique=True),)
 
 # Shared Quiz Models
 class Quiz(db.Model):
@@ -169,6 +463,8 @@ class Quiz(db.Model):
     difficulty = db.Column(db.String(20), default='beginner')  # beginner/intermediate/advanced
     duration_minutes = db.Column(db.Integer)  # optional time limit for test
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    content_version = db.Column(db.Integer, default=1)  # quiz_payload cache key; bump if questions ever change
+    __table_args__ = (db.Index('ix_quiz_created_by', 'created_by'),)
 
 class QuizQuestion(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -186,6 +482,7 @@ class QuizQuestion(db.Model):
     sample_input = db.Column(db.Text)  # Sample input for display
     sample_output = db.Column(db.Text)  # Sample output for display
     starter_code = db.Column(db.Text)  # Optional starter code template
+    __table_args__ = (db.Index('ix_quiz_question_quiz', 'quiz_id', 'id'),)
 
 class QuizSubmission(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -206,6 +503,12 @@ class QuizSubmission(db.Model):
     is_full_completion = db.Column(db.Boolean, default=False)
     started_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed = db.Column(db.Boolean, default=False)
+    # 'pending' while answers wait for the background grader, 'graded' once scores are final
+    grading_status = db.Column(db.String(20), default='graded')
+    __table_args__ = (
+        db.Index('ix_quiz_submission_quiz_student', 'quiz_id', 'student_id', 'completed'),
+        db.Index('ix_quiz_submission_student', 'student_id'),
+    )
 
 class QuizAnswer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -220,6 +523,135 @@ class QuizAnswer(db.Model):
     test_results_json = db.Column(db.Text)  # JSON array of test case results
     passed_test_cases = db.Column(db.Integer, default=0)
     total_test_cases = db.Column(db.Integer, default=0)
+    # Per-question counter from the autosave client; older deltas never overwrite newer ones
+    client_version = db.Column(db.Integer, default=0)
+    __table_args__ = (db.Index('uq_quiz_answer_submission_question', 'submission_id', 'question_id', unique=True),)
+
+# Pre-generated self-paced quiz questions, one row per question (see get_quiz_questions)
+class QuestionBankEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    topic_key = db.Column(db.String(200), nullable=False)  # normalized topic
+    difficulty = db.Column(db.String(20), nullable=False)
+    question_type = db.Column(db.String(20), nullable=False)
+    question_json = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_question_bank_lookup', 'topic_key', 'difficulty', 'question_type', 'id'),)
+
+# Memoized AI scores for subjective answers (see evaluate_subjective_answers)
+class AIScoreCache(db.Model):
+    key = db.Column(db.String(64), primary_key=True)  # sha256 of normalized question/answer/model answer/model
+    score = db.Column(db.Float, nullable=False)
+    model_name = db.Column(db.String(50))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Background grading queue (DB-backed, no external broker)
+class GradingJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    submission_id = db.Column(db.Integer, db.ForeignKey('quiz_submission.id'), nullable=False)
+    status = db.Column(db.String(20), default='queued', nullable=False)  # 'queued', 'running', 'done', 'failed'
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_grading_job_status', 'status', 'id'),
+        db.Index('ix_grading_job_submission', 'submission_id'),
+    )
+
+# Self-paced quiz attempts and teacher previews, kept server-side; the session only holds the id
+class QuizAttempt(db.Model):
+    id = db.Column(db.String(32), primary_key=True)  # random token stored in the session
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # 'current_quiz' or 'preview_quiz'
+    data_json = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# Parsed question list served to students taking a shared quiz (see get_quiz_payload)
+class QuizPayload(db.Model):
+    quiz_id = db.Column(db.Integer, db.ForeignKey('quiz.id'), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)  # Quiz.content_version it was built from
+    payload_json = db.Column(db.Text, nullable=False)
+    built_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Exam-start mode for a shared quiz: students queue in a lobby and are admitted at a fixed rate
+class ExamSession(db.Model):
+    quiz_id = db.Column(db.Integer, db.ForeignKey('quiz.id'), primary_key=True)
+    admit_per_minute = db.Column(db.Integer, nullable=False, default=120)
+    active = db.Column(db.Boolean, default=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Applied versions of SCHEMA_MIGRATIONS (see run_schema_migrations)
+class SchemaVersion(db.Model):
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(200))
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def insert_ignore_duplicates(model):
+    """INSERT statement for model that skips rows whose primary/unique key already exists"""
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql_insert(model).on_conflict_do_nothing()
+    if db.engine.dialect.name == 'sqlite':
+        return sqlite_insert(model).on_conflict_do_nothing()
+    return db.insert(model).prefix_with('IGNORE')
+
+# ---------------------------------------------------------------------------
+# Versioned schema migrations
+#
+# db.create_all() only creates missing tables, so changes to existing tables are listed in
+# SCHEMA_MIGRATIONS as (version, description, fn(conn)) and applied once, in order, by
+# run_schema_migrations(). Each migration runs in its own transaction and must be safe to
+# re-run, since two workers starting together can both attempt it.
+# ---------------------------------------------------------------------------
+def migrate_hot_path_indexes(conn):
+    from sqlalchemy import text
+    # Collapse duplicates the new unique indexes would reject, keeping the newest row
+    conn.execute(text(
+        "DELETE FROM quiz_answer WHERE id NOT IN "
+        "(SELECT MAX(id) FROM quiz_answer GROUP BY submission_id, question_id)"
+    ))
+    conn.execute(text(
+        "UPDATE progress SET bloom_level = (SELECT MAX(p.bloom_level) FROM progress p "
+        "WHERE p.user_id = progress.user_id AND p.topic = progress.topic) "
+        "WHERE id IN (SELECT MAX(id) FROM progress GROUP BY user_id, topic HAVING COUNT(*) > 1)"
+    ))
+    conn.execute(text(
+        "DELETE FROM progress WHERE id NOT IN (SELECT MAX(id) FROM progress GROUP BY user_id, topic)"
+    ))
+    for model in (Progress, Quiz, QuizQuestion, QuizSubmission, QuizAnswer, GradingJob):
+        for index in model.__table__.indexes:
+            index.create(bind=conn, checkfirst=True)
+
+def migrate_quiz_content_version(conn):
+    from sqlalchemy import inspect, text
+    columns = {column['name'] for column in inspect(conn).get_columns('quiz')}
+    if 'content_version' not in columns:
+        conn.execute(text("ALTER TABLE quiz ADD COLUMN content_version INTEGER DEFAULT 1"))
+
+def migrate_answer_client_version(conn):
+    from sqlalchemy import inspect, text
+    columns = {column['name'] for column in inspect(conn).get_columns('quiz_answer')}
+    if 'client_version' not in columns:
+        conn.execute(text("ALTER TABLE quiz_answer ADD COLUMN client_version INTEGER DEFAULT 0"))
+
+SCHEMA_MIGRATIONS = [
+    (1, 'Indexes for hot query paths; unique answers per question and progress per topic', migrate_hot_path_indexes),
+    (2, 'Quiz.content_version for the compiled quiz payload cache', migrate_quiz_content_version),
+    (3, 'QuizAnswer.client_version for incremental autosave', migrate_answer_client_version),
+]
+
+def run_schema_migrations():
+    """Apply SCHEMA_MIGRATIONS newer than those recorded in schema_version (needs an app context)"""
+    applied = {version for (version,) in db.session.query(SchemaVersion.version)}
+    db.session.commit()
+    for version, description, migrate in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+        with db.engine.begin() as conn:
+            migrate(conn)
+            conn.execute(insert_ignore_duplicates(SchemaVersion),
+                         [{'version': version, 'description': description, 'applied_at': datetime.utcnow()}])
+        print(f"Applied schema migration {version}: {description}")
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -231,8 +663,6 @@ def evaluate_subjective_answer(question, student_answer, model_answer):
         return 0.0
 
     try:
-        configure_google_ai()  # Ensure Google AI is configured
-        model = genai.GenerativeModel("gemini-2.0-flash")
         prompt = f"""
         Evaluate this student's answer for the given question:
 
@@ -249,7 +679,7 @@ def evaluate_subjective_answer(question, student_answer, model_answer):
         Return only a number between 0.0 and 1.0 (e.g., 0.8 for 80% correct)
         """
 
-        response = model.generate_content(prompt)
+        response = ai_generate('subjective_grading', prompt)
         score_text = response.text.strip()
 
         # Extract number from response
@@ -263,13 +693,502 @@ def evaluate_subjective_answer(question, student_answer, model_answer):
         print(f"Error in evaluate_subjective_answer: {str(e)}")
         return 0.5  # Default on error
 
+# Subjective answers are scored in batches: one structured-JSON prompt per chunk of
+# AI_GRADING_BATCH_SIZE answers, chunks sent in parallel on a small bounded pool
+AI_GRADING_BATCH_SIZE = int(os.environ.get('AI_GRADING_BATCH_SIZE', '10'))
+AI_MAX_CONCURRENCY = int(os.environ.get('AI_MAX_CONCURRENCY', '4'))
+_ai_executor = None
+_ai_executor_lock = threading.Lock()
+
+def get_ai_executor():
+    """Lazily create the process-wide thread pool used for parallel AI requests"""
+    global _ai_executor
+    if _ai_executor is None:
+        with _ai_executor_lock:
+            if _ai_executor is None:
+                _ai_executor = ThreadPoolExecutor(max_workers=max(1, AI_MAX_CONCURRENCY), thread_name_prefix='ai')
+    return _ai_executor
+
+BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', '4'))
+_background_executor = None
+
+def get_background_executor():
+    """
+    Pool for background and fan-out tasks that may themselves wait on AI calls.
+    Kept separate from the AI pool, which only runs leaf requests, so nested waits cannot deadlock.
+    """
+    global _background_executor
+    if _background_executor is None:
+        with _ai_executor_lock:
+            if _background_executor is None:
+                _background_executor = ThreadPoolExecutor(max_workers=max(1, BACKGROUND_WORKERS), thread_name_prefix='background')
+    return _background_executor
+
+def run_concurrently(calls):
+    """
+    Run independent (fn, args) calls at once and return their results in order.
+    The first call runs in the current thread; the others run on the background pool inside
+    their own app context (and therefore their own database session).
+    """
+    def in_app_context(fn, args):
+        with app.app_context():
+            return fn(*args)
+
+    if not calls:
+        return []
+    futures = [get_background_executor().submit(in_app_context, fn, args) for fn, args in calls[1:]]
+    first_fn, first_args = calls[0]
+    return [first_fn(*first_args)] + [future.result() for future in futures]
+
+def evaluate_subjective_chunk(items):
+    """Score up to AI_GRADING_BATCH_SIZE (question, answer, model_answer) items with one prompt"""
+    entries = "\n\n".join(
+        f"Item {n}:\nQuestion: {question}\nStudent Answer: {student_answer}\nModel Answer: {model_answer}"
+        for n, (question, student_answer, model_answer) in enumerate(items, start=1)
+    )
+    prompt = f"""
+    Evaluate each student's answer below against its question and model answer.
+
+    {entries}
+
+    Rate each student answer on a scale of 0.0 to 1.0 based on:
+    - Accuracy and correctness
+    - Completeness
+    - Understanding demonstrated
+    - Relevance to the question
+
+    Return ONLY a JSON array with one object per item, in order, like:
+    [{{"item": 1, "score": 0.8}}, {{"item": 2, "score": 0.4}}]
+    """
+
+    response = ai_generate('subjective_grading_batch', prompt)
+    text = response.text.strip()
+    json_match = re.search(r"\[.*\]", text, re.DOTALL)
+    parsed = json.loads(json_match.group(0) if json_match else text)
+
+    scores = {}
+    for entry in parsed:
+        scores[int(entry['item'])] = min(max(float(entry['score']), 0.0), 1.0)
+    if len(scores) != len(items) or set(scores) != set(range(1, len(items) + 1)):
+        raise ValueError(f"Expected {len(items)} scores, got {len(scores)}")
+    return [scores[n] for n in range(1, len(items) + 1)]
+
+def evaluate_subjective_answers(items):
+    """
+    Score many (question, student_answer, model_answer) triples, returning scores in order.
+    Blank answers score 0.0 without an AI call; the rest are graded in batched prompts run
+    in parallel. A chunk whose response cannot be parsed falls back to per-answer scoring.
+    """
+    scores = [0.0] * len(items)
+    pending = [i for i, (_, student_answer, _) in enumerate(items) if (student_answer or '').strip()]
+    if not genai or not pending:
+        return scores
+
+    # Answers already scored before (retakes, auto-submit then final submit) skip the AI
+    keys = {i: subjective_score_key(*items[i]) for i in pending}
+    cached = lookup_subjective_scores(set(keys.values()))
+    for i in list(pending):
+        if keys[i] in cached:
+            scores[i] = cached[keys[i]]
+    pending = [i for i in pending if keys[i] not in cached]
+    if not pending:
+        return scores
+
+    def score_chunk(chunk):
+        try:
+            return evaluate_subjective_chunk([items[i] for i in chunk]), True
+        except Exception as e:
+            print(f"Batch subjective evaluation failed, scoring individually: {e}")
+            # evaluate_subjective_answer falls back to 0.5 on errors, so these are not memoized
+            return [evaluate_subjective_answer(*items[i]) for i in chunk], False
+
+    size = max(1, AI_GRADING_BATCH_SIZE)
+    chunks = [pending[k:k + size] for k in range(0, len(pending), size)]
+    if len(chunks) == 1:
+        chunk_scores = [score_chunk(chunks[0])]
+    else:
+        chunk_scores = list(get_ai_executor().map(score_chunk, chunks))
+    fresh = {}
+    for chunk, (results, cacheable) in zip(chunks, chunk_scores):
+        for i, score in zip(chunk, results):
+            scores[i] = score
+            if cacheable:
+                fresh[keys[i]] = score
+    store_subjective_scores(fresh)
+    return scores
+
+class TTLCache:
+    """Thread-safe in-process LRU cache whose entries expire after ttl seconds"""
+
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl if ttl is not None else self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller runs the function and
+    everyone who arrives while it is in flight waits for, and gets, the same result or error.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+def single_flight(key=None):
+    """
+    Decorator that coalesces concurrent calls with the same arguments into one upstream call.
+    key(*args, **kwargs) builds the coalescing key (default: the arguments themselves). Every
+    caller gets its own deep copy of the result, so callers can mutate it freely.
+    """
+    def decorator(fn):
+        flight = SingleFlight()
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            flight_key = key(*args, **kwargs) if key else (args, tuple(sorted(kwargs.items())))
+            return copy.deepcopy(flight.do(flight_key, fn, *args, **kwargs))
+
+        wrapper.flight = flight
+        return wrapper
+    return decorator
+
+# Subjective score memo: an in-process TTLCache in front of the ai_score_cache table.
+# Keys hash the normalized question, answer and model answer plus the model name, so a
+# model change never reuses old scores. Rows older than AI_SCORE_CACHE_TTL_DAYS and rows
+# beyond AI_SCORE_CACHE_MAX_ROWS are pruned periodically.
+AI_SCORE_CACHE_TTL_DAYS = int(os.environ.get('AI_SCORE_CACHE_TTL_DAYS', '30'))
+AI_SCORE_CACHE_MAX_ROWS = int(os.environ.get('AI_SCORE_CACHE_MAX_ROWS', '20000'))
+subjective_score_memory = TTLCache(maxsize=4096, ttl=6 * 3600)
+_subjective_score_writes = 0
+
+def normalize_answer_text(text):
+    return re.sub(r'\s+', ' ', (text or '').strip().lower())
+
+def subjective_score_key(question, student_answer, model_answer):
+    parts = [
+        hashlib.sha256(normalize_answer_text(question).encode('utf-8')).hexdigest(),
+        hashlib.sha256(normalize_answer_text(student_answer).encode('utf-8')).hexdigest(),
+        hashlib.sha256(normalize_answer_text(model_answer).encode('utf-8')).hexdigest(),
+        GEMINI_MODEL,
+    ]
+    return hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()
+
+def lookup_subjective_scores(keys):
+    """Return {key: score} for memoized keys (memory first, then one DB query)"""
+    found = {}
+    for key in keys:
+        score = subjective_score_memory.get(key)
+        if score is not None:
+            found[key] = score
+    missing = [key for key in keys if key not in found]
+    if missing:
+        try:
+            from datetime import timedelta
+            cutoff = datetime.utcnow() - timedelta(days=AI_SCORE_CACHE_TTL_DAYS)
+            # Savepoint: a failed lookup must not abort the caller's transaction (Postgres)
+            with db.session.begin_nested():
+                rows = db.session.query(AIScoreCache.key, AIScoreCache.score).filter(
+                    AIScoreCache.key.in_(missing), AIScoreCache.created_at >= cutoff
+                ).all()
+            for key, score in rows:
+                found[key] = score
+                subjective_score_memory.set(key, score)
+        except Exception as e:
+            print(f"AI score cache lookup failed: {e}")
+    return found
+
+def store_subjective_scores(scores):
+    """
+    Memoize {key: score}. Rows are written through the current session (committed with
+    the caller's transaction) and duplicate keys from concurrent graders are ignored.
+    """
+    global _subjective_score_writes
+    if not scores:
+        return
+    for key, score in scores.items():
+        subjective_score_memory.set(key, score)
+    try:
+        now = datetime.utcnow()
+        # Savepoint: a failed memo write is rolled back alone, leaving the caller's grading intact
+        with db.session.begin_nested():
+            db.session.execute(
+                insert_ignore_duplicates(AIScoreCache),
+                [{'key': key, 'score': score, 'model_name': GEMINI_MODEL, 'created_at': now} for key, score in scores.items()]
+            )
+            _subjective_score_writes += len(scores)
+            if _subjective_score_writes >= 500:
+                _subjective_score_writes = 0
+                prune_subjective_scores()
+    except Exception as e:
+        print(f"AI score cache write failed: {e}")
+
+def prune_subjective_scores():
+    from datetime import timedelta
+    cutoff = datetime.utcnow() - timedelta(days=AI_SCORE_CACHE_TTL_DAYS)
+    db.session.query(AIScoreCache).filter(AIScoreCache.created_at < cutoff).delete(synchronize_session=False)
+    overflow = db.session.query(AIScoreCache.created_at).order_by(AIScoreCache.created_at.desc()).offset(
+        AI_SCORE_CACHE_MAX_ROWS).limit(1).scalar()
+    if overflow is not None:
+        db.session.query(AIScoreCache).filter(AIScoreCache.created_at <= overflow).delete(synchronize_session=False)
+
+# Outbound HTTP for code execution: one shared session so calls reuse keep-alive
+# connections from a per-host pool instead of opening a fresh TLS connection each time
+PISTON_URL = os.environ.get('PISTON_API_URL', 'https://emkc.org/api/v2/piston/execute')
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', os.environ.get('CODE_EXEC_MAX_WORKERS', '8')))
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Process-wide requests session with pooled keep-alive connections and a small retry policy"""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session_ = requests.Session()
+                # Shared across threads, so never let responses mutate a cookie jar
+                session_.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+                # Retry connection failures (nothing was sent yet) for any method, and gateway
+                # errors only for idempotent ones: a POST that reached the upstream may already
+                # be running or queued, so retrying it could duplicate the execution
+                retry = Retry(
+                    total=2,
+                    connect=2,
+                    read=0,
+                    status=2,
+                    backoff_factor=0.2,
+                    status_forcelist=(502, 503, 504),
+                    allowed_methods=frozenset(['GET', 'PUT']),
+                    raise_on_status=False
+                )
+                for host in {urlsplit(PISTON_URL), urlsplit(get_judge0_url())}:
+                    session_.mount(f"{host.scheme}://{host.netloc}", HTTPAdapter(
+                        pool_connections=1, pool_maxsize=max(1, HTTP_POOL_MAXSIZE), max_retries=retry
+                    ))
+                adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(1, HTTP_POOL_MAXSIZE), max_retries=retry)
+                session_.mount('https://', adapter)
+                session_.mount('http://', adapter)
+                _http_session = session_
+    return _http_session
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream after repeated failures. Once open, calls are refused for
+    reset_timeout seconds; then a single trial call is let through and its outcome
+    closes or re-opens the circuit.
+    """
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"Circuit breaker '{self.name}' opened after {self.failures} failures", file=sys.stderr)
+                self.opened_at = time.monotonic()
+
+piston_breaker = CircuitBreaker(
+    'piston',
+    failure_threshold=int(os.environ.get('PISTON_BREAKER_THRESHOLD', '3')),
+    reset_timeout=float(os.environ.get('PISTON_BREAKER_RESET_SECONDS', '30'))
+)
+
+# Execution results are content-addressed: identical (language, source, stdin, limits)
+# runs are served from memory, with an optional SQLite file (CODE_EXEC_CACHE_DB) shared
+# between worker processes. Infrastructure failures and time-limit verdicts are never
+# cached since they depend on upstream load rather than the code.
+CODE_EXEC_CACHE_TTL = int(os.environ.get('CODE_EXEC_CACHE_TTL', '3600'))
+NON_CACHEABLE_MESSAGES = ('API Error', 'Execution error', 'Timeout waiting', 'No token received', 'Time Limit Exceeded')
+
+class ExecutionResultCache:
+    """Two-tier (memory + optional SQLite) cache of code execution results"""
+
+    def __init__(self, maxsize=2048, ttl=3600, db_path=None, db_max_rows=50000):
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.db_max_rows = db_max_rows
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._writes = 0
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS exec_result_cache ("
+                    "key TEXT PRIMARY KEY, result TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                self._db.commit()
+            except Exception as e:
+                print(f"Execution cache database unavailable ({db_path}): {e}")
+                self._db = None
+
+    @staticmethod
+    def make_key(code, language, test_input, time_limit, memory_limit):
+        raw = json.dumps([language.lower(), code, test_input or '', time_limit, memory_limit])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def is_cacheable(exec_result):
+        if exec_result.get('status') == 'success':
+            return True
+        message = exec_result.get('message') or ''
+        return bool(message) and not message.startswith(NON_CACHEABLE_MESSAGES)
+
+    def get(self, key):
+        exec_result = self.memory.get(key)
+        if exec_result is not None or self._db is None:
+            return exec_result
+        try:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT result FROM exec_result_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+                ).fetchone()
+        except Exception as e:
+            print(f"Execution cache read failed: {e}")
+            return None
+        if row is None:
+            return None
+        exec_result = json.loads(row[0])
+        self.memory.set(key, exec_result)
+        return exec_result
+
+    def set(self, key, exec_result):
+        if not self.is_cacheable(exec_result):
+            return
+        self.memory.set(key, exec_result)
+        if self._db is None:
+            return
+        try:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO exec_result_cache (key, result, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(exec_result), time.time() + self.ttl)
+                )
+                self._writes += 1
+                if self._writes % 500 == 0:
+                    # Drop expired rows, then the soonest-expiring ones beyond the row budget
+                    self._db.execute("DELETE FROM exec_result_cache WHERE expires_at <= ?", (time.time(),))
+                    self._db.execute(
+                        "DELETE FROM exec_result_cache WHERE key IN (SELECT key FROM exec_result_cache "
+                        "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)", (self.db_max_rows,)
+                    )
+                self._db.commit()
+        except Exception as e:
+            print(f"Execution cache write failed: {e}")
+
+execution_cache = ExecutionResultCache(
+    maxsize=int(os.environ.get('CODE_EXEC_CACHE_SIZE', '2048')),
+    ttl=CODE_EXEC_CACHE_TTL,
+    db_path=os.environ.get('CODE_EXEC_CACHE_DB'),
+    db_max_rows=int(os.environ.get('CODE_EXEC_CACHE_DB_MAX_ROWS', '50000'))
+)
+
 def execute_code(code, language, test_input, time_limit=2, memory_limit=256):
+    """Execute code with the configured execution backend (see CODE_EXEC_BACKEND), using the result cache"""
+    key = ExecutionResultCache.make_key(code, language, test_input, time_limit, memory_limit)
+    exec_result = execution_cache.get(key)
+    if exec_result is None:
+        exec_result = get_execution_backend(language).execute(code, language, test_input, time_limit, memory_limit)
+        execution_cache.set(key, exec_result)
+    return exec_result
+
+def piston_was_killed(stage):
+    """True when Piston killed a compile/run stage (timeout or CPU limit) instead of it exiting"""
+    if not stage:
+        return False
+    return stage.get('status') == 'TO' or stage.get('signal') in ('SIGKILL', 'SIGXCPU')
+
+def execute_code_remote(code, language, test_input, time_limit=2, memory_limit=256):
     """
     Execute code using Piston API (free, no API key needed)
     Alternative: Judge0 API
     """
     # Try Piston API first (simpler, free)
-    piston_url = "https://emkc.org/api/v2/piston/execute"
+    piston_url = PISTON_URL
     
     # Piston language mapping
     piston_languages = {
@@ -282,6 +1201,13 @@ def execute_code(code, language, test_input, time_limit=2, memory_limit=256):
     
     piston_lang = piston_languages.get(language.lower(), 'python3')
     
+    # While Piston is known to be down, go straight to the fallback instead of waiting on it
+    if not piston_breaker.allow():
+        return execute_code_judge0(code, language, test_input, time_limit, memory_limit)
+
+    # Every path below records an outcome, so a half-open trial always ends. Piston counts as
+    # down on transport errors, 5xx/429 and unusable 200s; other 4xx blame the request
+    piston_up = False
     try:
         payload = {
             "language": piston_lang,
@@ -299,12 +1225,21 @@ def execute_code(code, language, test_input, time_limit=2, memory_limit=256):
             "run_memory_limit": memory_limit * 1024 * 1024
         }
         
-        response = requests.post(piston_url, json=payload, timeout=15)
+        response = get_http_session().post(piston_url, json=payload, timeout=15)
         
         if response.status_code == 200:
             result = response.json()
             if result.get('run'):
+                piston_up = True
                 run_result = result['run']
+                if piston_was_killed(run_result) or piston_was_killed(result.get('compile')):
+                    # Piston kills runs that hit its time limit (more often when it is loaded)
+                    return {
+                        'status': 'error',
+                        'message': 'Time Limit Exceeded',
+                        'output': (run_result.get('stdout') or '').strip(),
+                        'stderr': (run_result.get('stderr') or '').strip()
+                    }
                 if run_result.get('code') == 0:
                     return {
                         'status': 'success',
@@ -322,7 +1257,16 @@ def execute_code(code, language, test_input, time_limit=2, memory_limit=256):
                     }
             elif result.get('compile'):
                 compile_result = result['compile']
+                if piston_was_killed(compile_result):
+                    piston_up = True
+                    return {
+                        'status': 'error',
+                        'message': 'Time Limit Exceeded',
+                        'output': '',
+                        'stderr': 'Compilation timed out'
+                    }
                 if compile_result.get('code') != 0:
+                    piston_up = True
                     return {
                         'status': 'error',
                         'message': 'Compilation Error',
@@ -334,6 +1278,7 @@ def execute_code(code, language, test_input, time_limit=2, memory_limit=256):
             return execute_code_judge0(code, language, test_input, time_limit, memory_limit)
         else:
             # Fallback: Try Judge0 if Piston fails
+            piston_up = 400 <= response.status_code < 500 and response.status_code != 429
             return execute_code_judge0(code, language, test_input, time_limit, memory_limit)
         
     except requests.exceptions.RequestException:
@@ -346,34 +1291,151 @@ def execute_code(code, language, test_input, time_limit=2, memory_limit=256):
             'output': '',
             'stderr': ''
         }
+    finally:
+        if piston_up:
+            piston_breaker.record_success()
+        else:
+            piston_breaker.record_failure()
+
+# Judge0 language ids (CE edition)
+JUDGE0_LANGUAGE_IDS = {
+    'python': 71,
+    'python3': 71,
+    'java': 62,
+    'cpp': 54,
+    'c': 50
+}
+
+# Languages with a separate compile step; these benefit from batch execution
+COMPILED_LANGUAGES = {'java', 'cpp', 'c'}
+
+def get_judge0_url():
+    # Use Judge0 CE (free community edition)
+    return os.environ.get('JUDGE0_API_URL', 'https://ce.judge0.com')
+
+def build_judge0_payload(code, language, test_input, time_limit=2, memory_limit=256):
+    return {
+        "source_code": code,
+        "language_id": JUDGE0_LANGUAGE_IDS.get(language.lower(), 71),
+        "stdin": test_input,
+        "cpu_time_limit": time_limit,
+        "memory_limit": memory_limit * 1024
+    }
+
+def parse_judge0_result(result):
+    """Convert a Judge0 submission into our result dict, or None while it is still queued/running"""
+    status_id = (result.get('status') or {}).get('id', 0)
+
+    if status_id == 3:  # Accepted
+        return {
+            'status': 'success',
+            'output': (result.get('stdout') or '').strip(),
+            'stderr': (result.get('stderr') or '').strip(),
+            'time': result.get('time', ''),
+            'memory': result.get('memory', '')
+        }
+    elif status_id in [4, 5, 6, 7, 8, 9, 10, 11, 12]:
+        return {
+            'status': 'error',
+            'message': result.get('status', {}).get('description', 'Execution Error'),
+            'output': (result.get('stdout') or '').strip(),
+            'stderr': (result.get('stderr') or '').strip() or (result.get('compile_output') or '').strip()
+        }
+    return None
+
+# Judge0 completion: wait=true on single submissions, then polling with exponential backoff
+# and jitter. If JUDGE0_CALLBACK_URL points at /api/judge0/callback, Judge0 pushes results
+# there and waiting pollers wake up immediately instead of sleeping out their backoff.
+JUDGE0_POLL_TIMEOUT = float(os.environ.get('JUDGE0_POLL_TIMEOUT', '20'))
+JUDGE0_POLL_MAX_DELAY = 2.0
+_judge0_waiters = {}  # token -> threading.Event of the poller waiting on it
+_judge0_callback_results = {}  # token -> submission pushed by Judge0
+_judge0_waiters_lock = threading.Lock()
+
+def build_judge0_submission(code, language, test_input, time_limit=2, memory_limit=256):
+    payload = build_judge0_payload(code, language, test_input, time_limit, memory_limit)
+    callback_url = os.environ.get('JUDGE0_CALLBACK_URL')
+    if callback_url:
+        payload['callback_url'] = callback_url
+    return payload
+
+def judge0_timeout_result():
+    return {
+        'status': 'error',
+        'message': 'Timeout waiting for execution result',
+        'output': '',
+        'stderr': ''
+    }
+
+def poll_judge0_tokens(judge0_url, tokens, timeout=None, stop_on_compile_error=False):
+    """
+    Wait for Judge0 submissions to finish, returning results aligned with tokens
+    (None for any still unfinished at the deadline). Unfinished tokens are fetched
+    together through /submissions/batch; between rounds the thread waits with
+    exponential backoff and jitter, and wakes early when a callback arrives.
+    """
+    exec_results = [None] * len(tokens)
+    deadline = time.monotonic() + (timeout if timeout is not None else JUDGE0_POLL_TIMEOUT)
+    delay = 0.1
+    wakeup = threading.Event()
+    with _judge0_waiters_lock:
+        for token in tokens:
+            _judge0_waiters[token] = wakeup
+
+    try:
+        while True:
+            with _judge0_waiters_lock:
+                for i, token in enumerate(tokens):
+                    if exec_results[i] is None and token in _judge0_callback_results:
+                        exec_results[i] = parse_judge0_result(_judge0_callback_results.pop(token))
+
+            pending = [i for i, r in enumerate(exec_results) if r is None]
+            if pending:
+                try:
+                    result_response = get_http_session().get(
+                        f"{judge0_url}/submissions/batch",
+                        params={
+                            'tokens': ','.join(tokens[i] for i in pending),
+                            'base64_encoded': 'false',
+                            'fields': 'token,stdout,stderr,compile_output,status,time,memory'
+                        },
+                        timeout=10
+                    )
+                    if result_response.status_code == 200:
+                        for i, result in zip(pending, result_response.json().get('submissions', [])):
+                            exec_results[i] = parse_judge0_result(result or {})
+                except requests.exceptions.RequestException as e:
+                    print(f"Judge0 poll failed: {e}")
+
+            if stop_on_compile_error:
+                compile_error = next((r for r in exec_results if r is not None and is_compile_error(r)), None)
+                if compile_error is not None:
+                    return [compile_error] * len(tokens)
+
+            remaining = deadline - time.monotonic()
+            if all(r is not None for r in exec_results) or remaining <= 0:
+                return exec_results
+
+            wakeup.wait(min(remaining, delay * random.uniform(0.5, 1.0)))
+            wakeup.clear()
+            delay = min(delay * 2, JUDGE0_POLL_MAX_DELAY)
+    finally:
+        with _judge0_waiters_lock:
+            for token in tokens:
+                _judge0_waiters.pop(token, None)
+                _judge0_callback_results.pop(token, None)
 
 def execute_code_judge0(code, language, test_input, time_limit=2, memory_limit=256):
     """Fallback: Execute code using Judge0 API"""
-    language_map = {
-        'python': 71,
-        'python3': 71,
-        'java': 62,
-        'cpp': 54,
-        'c': 50
-    }
-    
-    language_id = language_map.get(language.lower(), 71)
-    
-    # Use Judge0 CE (free community edition)
-    judge0_url = os.environ.get('JUDGE0_API_URL', 'https://ce.judge0.com')
+    judge0_url = get_judge0_url()
     
     try:
-        # Submit
-        submit_url = f"{judge0_url}/submissions"
-        payload = {
-            "source_code": code,
-            "language_id": language_id,
-            "stdin": test_input,
-            "cpu_time_limit": time_limit,
-            "memory_limit": memory_limit * 1024
-        }
+        # Submit and ask Judge0 to hold the response until the run finishes
+        submit_url = f"{judge0_url}/submissions?base64_encoded=false&wait=true"
+        payload = build_judge0_submission(code, language, test_input, time_limit, memory_limit)
         
-        response = requests.post(submit_url, json=payload, headers={'Content-Type': 'application/json'}, timeout=10)
+        response = get_http_session().post(submit_url, json=payload, headers={'Content-Type': 'application/json'},
+                                 timeout=time_limit + 15)
         
         if response.status_code not in [201, 200]:
             return {
@@ -384,6 +1446,11 @@ def execute_code_judge0(code, language, test_input, time_limit=2, memory_limit=2
             }
         
         submission_data = response.json()
+        exec_result = parse_judge0_result(submission_data)
+        if exec_result is not None:
+            return exec_result
+
+        # Instances with wait disabled only return a token
         token = submission_data.get('token')
         
         if not token:
@@ -394,60 +1461,622 @@ def execute_code_judge0(code, language, test_input, time_limit=2, memory_limit=2
                 'stderr': ''
             }
         
-        # Poll for results
-        for attempt in range(10):
-            time.sleep(0.5)
-            
-            result_url = f"{judge0_url}/submissions/{token}"
-            result_response = requests.get(result_url, timeout=10)
-            
-            if result_response.status_code == 200:
-                result = result_response.json()
-                status_id = result.get('status', {}).get('id', 0)
-                
-                if status_id == 3:  # Accepted
-                    return {
-                        'status': 'success',
-                        'output': result.get('stdout', '').strip(),
-                        'stderr': result.get('stderr', '').strip(),
-                        'time': result.get('time', ''),
-                        'memory': result.get('memory', '')
-                    }
-                elif status_id in [4, 5, 6, 7, 8, 9, 10, 11, 12]:
-                    return {
-                        'status': 'error',
-                        'message': result.get('status', {}).get('description', 'Execution Error'),
-                        'output': result.get('stdout', '').strip(),
-                        'stderr': result.get('stderr', '').strip() or result.get('compile_output', '').strip()
-                    }
+        return poll_judge0_tokens(judge0_url, [token])[0] or judge0_timeout_result()
         
+    except Exception as e:
         return {
             'status': 'error',
-            'message': 'Timeout waiting for execution result',
+            'message': f'Execution error: {str(e)}',
             'output': '',
             'stderr': ''
         }
-        
+
+def execute_code_judge0_batch(code, language, inputs, time_limit=2, memory_limit=256):
+    """
+    Execute one program against many inputs with a single Judge0 batch submission.
+    All tokens are polled together, and the first compilation error is reused for every
+    input. Returns None if the batch API is unavailable so callers can fall back.
+    """
+    judge0_url = get_judge0_url()
+
+    try:
+        payload = {
+            "submissions": [
+                build_judge0_submission(code, language, test_input, time_limit, memory_limit)
+                for test_input in inputs
+            ]
+        }
+        response = get_http_session().post(f"{judge0_url}/submissions/batch?base64_encoded=false", json=payload,
+                                 headers={'Content-Type': 'application/json'}, timeout=10)
+        if response.status_code not in [201, 200]:
+            return None
+
+        tokens = [item.get('token') for item in response.json()]
+        if not all(tokens):
+            return None
+
+        exec_results = poll_judge0_tokens(judge0_url, tokens, stop_on_compile_error=True)
+        return [r if r is not None else judge0_timeout_result() for r in exec_results]
+
     except Exception as e:
+        print(f"Judge0 batch execution failed: {e}")
+        return None
+
+def execute_code_batch(code, language, inputs, time_limit=2, memory_limit=256):
+    """
+    Execute one program against a list of stdin inputs, returning results in input order.
+    Inputs already in the result cache are not sent to the backend.
+    """
+    keys = [ExecutionResultCache.make_key(code, language, test_input, time_limit, memory_limit) for test_input in inputs]
+    exec_results = [execution_cache.get(key) for key in keys]
+    missing = [i for i, r in enumerate(exec_results) if r is None]
+    if missing:
+        fresh = get_execution_backend(language).execute_batch(
+            code, language, [inputs[i] for i in missing], time_limit, memory_limit
+        )
+        for i, exec_result in zip(missing, fresh):
+            exec_results[i] = exec_result
+            execution_cache.set(keys[i], exec_result)
+    return exec_results
+
+# Shared pool for outbound code execution; bounds how many test cases run at once
+CODE_EXEC_MAX_WORKERS = int(os.environ.get('CODE_EXEC_MAX_WORKERS', '8'))
+_code_exec_executor = None
+_code_exec_executor_lock = threading.Lock()
+
+def get_code_exec_executor():
+    """Lazily create the process-wide thread pool used for test-case execution"""
+    global _code_exec_executor
+    if _code_exec_executor is None:
+        with _code_exec_executor_lock:
+            if _code_exec_executor is None:
+                _code_exec_executor = ThreadPoolExecutor(
+                    max_workers=max(1, CODE_EXEC_MAX_WORKERS),
+                    thread_name_prefix='code-exec'
+                )
+    return _code_exec_executor
+
+def is_compile_error(exec_result):
+    """True if an execution result is a compilation failure (same for every input)"""
+    return exec_result.get('status') == 'error' and 'compil' in (exec_result.get('message') or '').lower()
+
+def execute_test_inputs(code, language, inputs, time_limit=2, memory_limit=256, execute=None):
+    """
+    Execute code against several stdin inputs concurrently.
+    Results are returned in input order. If any input hits a compilation error the
+    remaining executions are cancelled and reuse that result, since they would fail the same way.
+    """
+    exec_results = [None] * len(inputs)
+    if not inputs:
+        return exec_results
+
+    execute = execute or execute_code
+    executor = get_code_exec_executor()
+    futures = {
+        executor.submit(execute, code, language, test_input, time_limit, memory_limit): i
+        for i, test_input in enumerate(inputs)
+    }
+    pending = set(futures)
+    compile_error = None
+    while pending and compile_error is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                exec_result = future.result()
+            except Exception as e:
+                exec_result = {
+                    'status': 'error',
+                    'message': f'Execution error: {str(e)}',
+                    'output': '',
+                    'stderr': ''
+                }
+            exec_results[futures[future]] = exec_result
+            if compile_error is None and is_compile_error(exec_result):
+                compile_error = exec_result
+
+    if compile_error is not None:
+        for future in pending:
+            future.cancel()
+        exec_results = [r if r is not None else compile_error for r in exec_results]
+    return exec_results
+
+# ---------------------------------------------------------------------------
+# Execution backends
+#
+# CODE_EXEC_BACKEND selects where submissions run:
+#   remote - public Piston API with Judge0 fallback (default)
+#   local  - subprocesses on this machine, each in its own mount/pid/net namespace chrooted
+#            into an empty tmpfs (read-only toolchain binds, private /proc), as a dedicated
+#            unprivileged uid with rlimits on CPU, memory, processes and files, plus a
+#            pre-warmed interpreter pool for Python. Needs root and util-linux `unshare`;
+#            when that isolation can't be set up the local backend is refused and remote is
+#            used. Languages without a local toolchain use remote.
+# ---------------------------------------------------------------------------
+CODE_EXEC_BACKEND = os.environ.get('CODE_EXEC_BACKEND', 'remote').lower()
+CODE_EXEC_PYTHON_POOL_SIZE = int(os.environ.get('CODE_EXEC_PYTHON_POOL_SIZE', '2'))
+CODE_EXEC_ARTIFACT_CACHE_SIZE = int(os.environ.get('CODE_EXEC_ARTIFACT_CACHE_SIZE', '64'))
+CODE_EXEC_MAX_OUTPUT_BYTES = 64 * 1024
+# Sandboxed runs get a uid of their own from this range (ids with no account on the host)
+CODE_EXEC_SANDBOX_UID_BASE = int(os.environ.get('CODE_EXEC_SANDBOX_UID_BASE', '100000'))
+CODE_EXEC_SANDBOX_UIDS = int(os.environ.get('CODE_EXEC_SANDBOX_UIDS', '64'))
+CODE_EXEC_SANDBOX_NPROC = int(os.environ.get('CODE_EXEC_SANDBOX_NPROC', '64'))
+# Extra host paths (colon-separated) bound read-only into the sandbox, e.g. a JDK outside /usr
+CODE_EXEC_SANDBOX_PATHS = [p for p in os.environ.get('CODE_EXEC_SANDBOX_PATHS', '').split(':') if p]
+
+class RemoteExecutionBackend:
+    """Public Piston API with Judge0 fallback"""
+    name = 'remote'
+
+    def supports(self, language):
+        return True
+
+    def execute(self, code, language, test_input, time_limit=2, memory_limit=256):
+        return execute_code_remote(code, language, test_input, time_limit, memory_limit)
+
+    def execute_batch(self, code, language, inputs, time_limit=2, memory_limit=256):
+        # Compiled languages go through a single Judge0 batch submission; everything
+        # else (or a failed batch) runs per input on the shared execution pool.
+        # Piston has no multi-input endpoint, so that path is one Piston request per
+        # input (compiling each time) with Judge0 single submissions as fallback.
+        if language.lower() in COMPILED_LANGUAGES and len(inputs) > 1:
+            exec_results = execute_code_judge0_batch(code, language, inputs, time_limit, memory_limit)
+            if exec_results is not None:
+                return exec_results
+        return execute_test_inputs(code, language, inputs, time_limit, memory_limit, execute=self.execute)
+
+# Runs inside a pre-warmed interpreter: reads one JSON header line with the source and
+# limits, tightens its own rlimits, then executes the source with the rest of stdin as input
+PYTHON_WORKER_BOOTSTRAP = r"""
+import sys, json
+_header = json.loads(sys.stdin.buffer.readline())
+try:
+    import resource
+    _usage = resource.getrusage(resource.RUSAGE_SELF)
+    _cpu = int(_usage.ru_utime + _usage.ru_stime) + int(_header['cpu'])
+    resource.setrlimit(resource.RLIMIT_CPU, (_cpu, _cpu + 1))
+    resource.setrlimit(resource.RLIMIT_AS, (int(_header['mem']), int(_header['mem'])))
+except Exception:
+    pass
+_source = _header['code']
+del _header
+sys.argv = ['solution.py']
+exec(compile(_source, 'solution.py', 'exec'), {'__name__': '__main__', '__builtins__': __builtins__})
+"""
+
+# Runs as root inside fresh mount/pid/net/ipc/uts namespaces (pid 1 of its namespace):
+# builds an empty tmpfs root with read-only binds of the toolchain, a private /proc and
+# /tmp, chroots into it, drops to the run's uid with rlimits, then execs the program
+SANDBOX_LAUNCHER = r"""
+import ctypes, json, os, resource, sys
+spec = json.loads(sys.argv[1])
+libc = ctypes.CDLL(None, use_errno=True)
+MS_RDONLY, MS_NOSUID, MS_NODEV, MS_NOEXEC, MS_REMOUNT, MS_BIND, MS_REC, MS_PRIVATE = 1, 2, 4, 8, 32, 4096, 16384, 1 << 18
+
+def mount(source, target, fstype=None, flags=0, data=None):
+    if libc.mount(source.encode(), target.encode(), fstype.encode() if fstype else None, flags,
+                  data.encode() if data else None) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, 'mount %s: %s' % (target, os.strerror(error)))
+
+def bind(source, target, writable=False):
+    dest = root + target
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), dest)
+        return
+    if os.path.isdir(source):
+        os.makedirs(dest, exist_ok=True)
+    else:
+        open(dest, 'a').close()
+    mount(source, dest, flags=MS_BIND | MS_REC)
+    mount('none', dest, flags=MS_REMOUNT | MS_BIND | MS_NOSUID | MS_NODEV | (0 if writable else MS_RDONLY))
+
+try:
+    root = spec['root']
+    mount('none', '/', flags=MS_REC | MS_PRIVATE)
+    mount('tmpfs', root, 'tmpfs', MS_NOSUID | MS_NODEV, 'size=16m,mode=755')
+    for path in spec['ro_paths']:
+        if os.path.lexists(path):
+            bind(path, path)
+    for device in ('null', 'zero', 'random', 'urandom'):
+        bind('/dev/' + device, '/dev/' + device, writable=True)
+    os.makedirs(root + '/proc')
+    mount('proc', root + '/proc', 'proc', MS_NOSUID | MS_NODEV | MS_NOEXEC)
+    os.makedirs(root + '/tmp')
+    mount('tmpfs', root + '/tmp', 'tmpfs', MS_NOSUID | MS_NODEV, 'size=16m,mode=1777')
+    if spec.get('box'):
+        bind(spec['box'], '/box', writable=spec.get('writable', False))
+    else:
+        os.makedirs(root + '/box')
+    os.chroot(root)
+    os.chdir('/box')
+
+    limits = [(resource.RLIMIT_CORE, 0), (resource.RLIMIT_FSIZE, 16 * 1024 * 1024),
+              (resource.RLIMIT_NOFILE, 64), (resource.RLIMIT_NPROC, spec['nproc'])]
+    if spec.get('cpu'):
+        limits.append((resource.RLIMIT_CPU, spec['cpu']))
+    if spec.get('mem'):
+        limits.append((resource.RLIMIT_AS, spec['mem']))
+    for limit, value in limits:
+        resource.setrlimit(limit, (value, value + 1 if limit == resource.RLIMIT_CPU else value))
+    os.setgroups([])
+    os.setgid(spec['uid'])
+    os.setuid(spec['uid'])
+    libc.prctl(38, 1, 0, 0, 0)  # PR_SET_NO_NEW_PRIVS
+except Exception as e:
+    sys.stderr.write('sandbox setup failed: %s\n' % e)
+    os._exit(125)
+os.execvpe(spec['cmd'][0], spec['cmd'], spec['env'])
+"""
+
+# Exit status the launcher uses when the sandbox itself could not be built
+SANDBOX_SETUP_FAILED = 125
+
+class SandboxUnavailable(RuntimeError):
+    pass
+
+class CodeSandbox:
+    """Starts untrusted programs through SANDBOX_LAUNCHER, each with a uid no other run is using"""
+
+    def __init__(self):
+        if resource is None or not sys.platform.startswith('linux'):
+            raise SandboxUnavailable('needs Linux')
+        if os.geteuid() != 0:
+            raise SandboxUnavailable('needs root to build namespaces and switch to the sandbox uid')
+        if not shutil.which('unshare'):
+            raise SandboxUnavailable('util-linux unshare not found')
+        self.python = os.path.realpath(sys.executable)
+        self.root = tempfile.mkdtemp(prefix='unitest-sandbox-')
+        self.ro_paths = ['/usr', '/bin', '/sbin', '/lib', '/lib32', '/lib64', '/libx32', '/etc/alternatives',
+                         '/etc/ld.so.cache', '/etc/ld.so.conf', '/etc/ld.so.conf.d', sys.base_prefix]
+        self.ro_paths += CODE_EXEC_SANDBOX_PATHS
+        self._free_uids = list(range(CODE_EXEC_SANDBOX_UID_BASE, CODE_EXEC_SANDBOX_UID_BASE + max(1, CODE_EXEC_SANDBOX_UIDS)))
+        self._uids = threading.Condition()
+        self.verify()
+
+    def verify(self):
+        """Check inside a real sandbox that the app, the host's processes and root are out of reach"""
+        app_dir = os.path.dirname(os.path.abspath(__file__))
+        probe = (f"import os, sys; sys.exit(0 if os.getuid() != 0 and os.getppid() == 0 "
+                 f"and not os.path.exists({app_dir!r}) and len([p for p in os.listdir('/proc') if p.isdigit()]) == 1 else 3)")
+        proc = self.popen([self.python, '-I', '-c', probe])
+        try:
+            _, stderr = proc.communicate(timeout=20)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.communicate()
+            raise SandboxUnavailable('isolation probe timed out')
+        finally:
+            self.release_uid(proc.sandbox_uid)
+        if proc.returncode != 0:
+            raise SandboxUnavailable(f"isolation probe failed ({proc.returncode}): {stderr.decode('utf-8', errors='replace').strip()}")
+
+    def acquire_uid(self):
+        with self._uids:
+            while not self._free_uids:
+                self._uids.wait()
+            return self._free_uids.pop()
+
+    def release_uid(self, uid):
+        with self._uids:
+            self._free_uids.append(uid)
+            self._uids.notify()
+
+    def popen(self, cmd, box=None, writable=False, cpu_seconds=None, memory_mb=None, env=None, uid=None):
+        """
+        Start cmd sandboxed; the caller must release_uid(proc.sandbox_uid) once it has exited.
+        uid may be one already taken with acquire_uid() (e.g. to chown the box first); it is
+        released the same way.
+        """
+        if uid is None:
+            uid = self.acquire_uid()
+        spec = {
+            'root': self.root, 'ro_paths': self.ro_paths, 'box': box, 'writable': writable, 'uid': uid,
+            'nproc': CODE_EXEC_SANDBOX_NPROC, 'cpu': int(cpu_seconds) if cpu_seconds else None,
+            'mem': memory_mb * 1024 * 1024 if memory_mb else None, 'cmd': cmd,
+            'env': {'PATH': '/usr/local/bin:/usr/bin:/bin', 'HOME': '/tmp', **(env or {})}
+        }
+        try:
+            proc = subprocess.Popen(
+                ['unshare', '--mount', '--pid', '--net', '--ipc', '--uts', '--fork', '--kill-child', '--',
+                 self.python, '-I', '-c', SANDBOX_LAUNCHER, json.dumps(spec)],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env={},
+                start_new_session=True
+            )
+        except Exception:
+            self.release_uid(uid)
+            raise
+        proc.sandbox_uid = uid
+        return proc
+
+    def run(self, proc, stdin_bytes, time_limit):
+        """Feed a started sandbox its input and wait for it (the namespace dies with its pid 1)"""
+        try:
+            return run_sandboxed_process(proc, stdin_bytes, time_limit)
+        finally:
+            self.release_uid(proc.sandbox_uid)
+
+def seal_build_dir(path):
+    """Hand a finished build back to root: world-readable, writable by no sandbox uid"""
+    for directory, dirs, files in os.walk(path):
+        os.chown(directory, 0, 0)
+        os.chmod(directory, 0o755)
+        for name in files:
+            file_path = os.path.join(directory, name)
+            os.chown(file_path, 0, 0)
+            os.chmod(file_path, 0o755 if os.stat(file_path).st_mode & 0o100 else 0o644)
+
+def build_local_result(returncode, stdout, stderr, elapsed, timed_out=False):
+    """Map a finished local process onto the same result dict the remote runners return"""
+    output = stdout[:CODE_EXEC_MAX_OUTPUT_BYTES].decode('utf-8', errors='replace').strip()
+    error_output = stderr[:CODE_EXEC_MAX_OUTPUT_BYTES].decode('utf-8', errors='replace').strip()
+    if returncode == SANDBOX_SETUP_FAILED and error_output.startswith('sandbox setup failed'):
+        print(f"Code sandbox error: {error_output}")
         return {
             'status': 'error',
-            'message': f'Execution error: {str(e)}',
+            'message': 'Execution error: sandbox unavailable',
             'output': '',
             'stderr': ''
         }
+    if timed_out or (resource is not None and returncode in (-signal.SIGXCPU, -signal.SIGKILL)):
+        return {
+            'status': 'error',
+            'message': 'Time Limit Exceeded',
+            'output': output,
+            'stderr': error_output
+        }
+    if returncode == 0:
+        return {
+            'status': 'success',
+            'output': output,
+            'stderr': error_output,
+            'time': f"{elapsed:.3f}",
+            'memory': ''
+        }
+    return {
+        'status': 'error',
+        'message': 'Memory Limit Exceeded' if 'MemoryError' in error_output else 'Runtime Error',
+        'output': output,
+        'stderr': error_output
+    }
+
+def run_sandboxed_process(proc, stdin_bytes, time_limit):
+    """Feed stdin to a started process and wait for it, killing it after the wall-clock limit"""
+    started = time.monotonic()
+    try:
+        stdout, stderr = proc.communicate(stdin_bytes, timeout=time_limit + 1)
+        return build_local_result(proc.returncode, stdout, stderr, time.monotonic() - started)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except Exception:
+            proc.kill()
+        stdout, stderr = proc.communicate()
+        return build_local_result(proc.returncode, stdout, stderr, time.monotonic() - started, timed_out=True)
+
+class PythonWorkerPool:
+    """Keeps a few interpreters started and idle so a Python run skips interpreter start-up"""
+
+    def __init__(self, sandbox, size):
+        self.sandbox = sandbox
+        self.size = max(0, size)
+        self._idle = []
+        self._lock = threading.Lock()
+        if self.size:
+            threading.Thread(target=self._refill, daemon=True).start()
+
+    def _spawn(self):
+        return self.sandbox.popen([self.sandbox.python, '-I', '-c', PYTHON_WORKER_BOOTSTRAP],
+                                  env={'PYTHONIOENCODING': 'utf-8'})
+
+    def _refill(self):
+        with self._lock:
+            missing = self.size - len(self._idle)
+        for _ in range(missing):
+            try:
+                proc = self._spawn()
+            except Exception as e:
+                print(f"Python worker spawn failed: {e}")
+                return
+            with self._lock:
+                self._idle.append(proc)
+
+    def acquire(self):
+        proc = None
+        with self._lock:
+            while self._idle and proc is None:
+                candidate = self._idle.pop()
+                if candidate.poll() is None:
+                    proc = candidate
+                else:
+                    self.sandbox.release_uid(candidate.sandbox_uid)
+        if self.size:
+            threading.Thread(target=self._refill, daemon=True).start()
+        return proc or self._spawn()
+
+    def run(self, code, test_input, time_limit=2, memory_limit=256):
+        header = json.dumps({'code': code, 'cpu': time_limit, 'mem': memory_limit * 1024 * 1024})
+        stdin_bytes = header.encode('utf-8') + b'\n' + (test_input or '').encode('utf-8')
+        return self.sandbox.run(self.acquire(), stdin_bytes, time_limit)
+
+class LocalExecutionBackend:
+    """Runs submissions as sandboxed subprocesses on this machine (raises SandboxUnavailable if it can't isolate them)"""
+    name = 'local'
+
+    # language -> (source file name, compile command, run command); {dir}, {cls} and {mem} are filled in
+    TOOLCHAINS = {
+        'c': ('main.c', ['gcc', '-O2', '-std=c11', '-o', '{dir}/main', '{dir}/main.c', '-lm'], ['{dir}/main']),
+        'cpp': ('main.cpp', ['g++', '-O2', '-std=c++17', '-o', '{dir}/main', '{dir}/main.cpp'], ['{dir}/main']),
+        'java': ('{cls}.java', ['javac', '-d', '{dir}', '{dir}/{cls}.java'],
+                 ['java', '-Xmx{mem}m', '-Xss64m', '-cp', '{dir}', '{cls}']),
+    }
+
+    def __init__(self):
+        self.sandbox = CodeSandbox()
+        self.python_pool = PythonWorkerPool(self.sandbox, CODE_EXEC_PYTHON_POOL_SIZE)
+        self._artifacts = OrderedDict()
+        self._artifact_locks = {}
+        self._artifact_refs = {}  # build dir -> runs using it
+        self._evicted_dirs = set()  # evicted while in use; deleted by the last release_artifact()
+        self._lock = threading.Lock()
+
+    def supports(self, language):
+        language = language.lower()
+        if language in ('python', 'python3'):
+            return resource is not None
+        toolchain = self.TOOLCHAINS.get(language)
+        return bool(toolchain and resource is not None and shutil.which(toolchain[1][0]))
+
+    def execute(self, code, language, test_input, time_limit=2, memory_limit=256):
+        return self.execute_batch(code, language, [test_input], time_limit, memory_limit)[0]
+
+    def execute_batch(self, code, language, inputs, time_limit=2, memory_limit=256):
+        language = language.lower()
+        if language in ('python', 'python3'):
+            run = lambda c, l, test_input, t, m: self.python_pool.run(c, test_input, t, m)
+            return execute_test_inputs(code, language, inputs, time_limit, memory_limit, execute=run)
+
+        # Compile once, then run every input against the cached artifact
+        artifact = self.get_artifact(code, language)
+        try:
+            if artifact.get('status') == 'error':
+                return [artifact] * len(inputs)
+            run = lambda c, l, test_input, t, m: self.run_artifact(artifact, language, test_input, t, m)
+            return execute_test_inputs(code, language, inputs, time_limit, memory_limit, execute=run)
+        finally:
+            self.release_artifact(artifact)
+
+    def get_artifact(self, code, language):
+        """Compile source (or return the cached build for the same source hash); pair with release_artifact()"""
+        key = hashlib.sha256(f"{language}\0{code}".encode('utf-8')).hexdigest()
+        with self._lock:
+            if key in self._artifacts:
+                self._artifacts.move_to_end(key)
+                return self._hold_artifact(self._artifacts[key])
+            key_lock = self._artifact_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                if key in self._artifacts:
+                    return self._hold_artifact(self._artifacts[key])
+            artifact = self.compile(code, language)
+            unused = []
+            with self._lock:
+                self._artifacts[key] = artifact
+                self._artifact_locks.pop(key, None)
+                self._hold_artifact(artifact)
+                while len(self._artifacts) > max(1, CODE_EXEC_ARTIFACT_CACHE_SIZE):
+                    _, evicted = self._artifacts.popitem(last=False)
+                    if not evicted.get('dir'):
+                        continue
+                    # A build still being run from is deleted when its last run finishes
+                    if self._artifact_refs.get(evicted['dir']):
+                        self._evicted_dirs.add(evicted['dir'])
+                    else:
+                        unused.append(evicted['dir'])
+            for directory in unused:
+                shutil.rmtree(directory, ignore_errors=True)
+            return artifact
+
+    def _hold_artifact(self, artifact):
+        """Count one more batch running from this build (call with self._lock held)"""
+        if artifact.get('dir'):
+            self._artifact_refs[artifact['dir']] = self._artifact_refs.get(artifact['dir'], 0) + 1
+        return artifact
+
+    def release_artifact(self, artifact):
+        directory = artifact.get('dir')
+        if not directory:
+            return
+        with self._lock:
+            self._artifact_refs[directory] -= 1
+            if self._artifact_refs[directory]:
+                return
+            del self._artifact_refs[directory]
+            if directory not in self._evicted_dirs:
+                return
+            self._evicted_dirs.discard(directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def compile(self, code, language):
+        source_name, compile_cmd, run_cmd = self.TOOLCHAINS[language]
+        class_match = re.search(r'public\s+class\s+(\w+)', code) if language == 'java' else None
+        cls = class_match.group(1) if class_match else 'Main'
+        build_dir = tempfile.mkdtemp(prefix='unitest-build-')
+        # Inside the sandbox the build directory is /box
+        fill = lambda parts: [p.replace('{dir}', '/box').replace('{cls}', cls) for p in parts]
+        with open(os.path.join(build_dir, source_name.replace('{cls}', cls)), 'w', encoding='utf-8') as f:
+            f.write(code)
+        # The compiler sees student source too, so it runs sandboxed with only the build dir
+        # writable; the dir is handed to its uid before the compiler starts
+        uid = self.sandbox.acquire_uid()
+        try:
+            os.chown(build_dir, uid, uid)
+            os.chown(os.path.join(build_dir, source_name.replace('{cls}', cls)), uid, uid)
+        except Exception:
+            self.sandbox.release_uid(uid)
+            raise
+        proc = self.sandbox.popen(fill(compile_cmd), box=build_dir, writable=True, cpu_seconds=10, uid=uid)
+        compiled = self.sandbox.run(proc, b'', 10)
+        seal_build_dir(build_dir)
+        if compiled['status'] != 'success':
+            shutil.rmtree(build_dir, ignore_errors=True)
+            return {
+                'status': 'error',
+                'message': 'Compilation Error',
+                'output': '',
+                'stderr': 'Compilation timed out' if compiled['message'] == 'Time Limit Exceeded' else compiled['stderr']
+            }
+        return {'status': 'compiled', 'dir': build_dir, 'run_cmd': fill(run_cmd)}
+
+    def run_artifact(self, artifact, language, test_input, time_limit=2, memory_limit=256):
+        run_cmd = [p.replace('{mem}', str(memory_limit)) for p in artifact['run_cmd']]
+        # The JVM reserves far more address space than it uses; -Xmx bounds Java instead
+        proc = self.sandbox.popen(run_cmd, box=artifact['dir'], cpu_seconds=time_limit,
+                                  memory_mb=None if language == 'java' else memory_limit)
+        return self.sandbox.run(proc, (test_input or '').encode('utf-8'), time_limit)
+
+EXECUTION_BACKENDS = {
+    'remote': RemoteExecutionBackend,
+    'local': LocalExecutionBackend,
+}
+_execution_backends = {}
+
+def get_execution_backend(language='python'):
+    """Return the configured backend, falling back to remote for languages it cannot run"""
+    name = CODE_EXEC_BACKEND if CODE_EXEC_BACKEND in EXECUTION_BACKENDS else 'remote'
+    with _code_exec_executor_lock:
+        if name not in _execution_backends:
+            try:
+                _execution_backends[name] = EXECUTION_BACKENDS[name]()
+            except SandboxUnavailable as e:
+                # Never run student code unisolated
+                print(f"CODE_EXEC_BACKEND={name} refused, code sandbox unavailable: {e}. Using remote execution.")
+                _execution_backends[name] = RemoteExecutionBackend()
+        backend = _execution_backends[name]
+        if 'remote' not in _execution_backends:
+            _execution_backends['remote'] = RemoteExecutionBackend()
+    if not backend.supports(language):
+        return _execution_backends['remote']
+    return backend
 
 def run_test_cases(code, language, test_cases, time_limit=2, memory_limit=256):
-    """Run multiple test cases and return results"""
+    """Run multiple test cases concurrently and return results in test-case order"""
     results = []
     passed = 0
-    
-    for test_case in test_cases:
+
+    exec_results = execute_code_batch(
+        code, language, [tc.get('input', '') for tc in test_cases], time_limit, memory_limit
+    )
+
+    for test_case, exec_result in zip(test_cases, exec_results):
         test_input = test_case.get('input', '')
         expected_output = test_case.get('expected_output', '').strip()
         is_hidden = test_case.get('is_hidden', False)
         
-        exec_result = execute_code(code, language, test_input, time_limit, memory_limit)
-        
         if exec_result['status'] == 'success':
             actual_output = exec_result['output'].strip()
             is_correct = actual_output == expected_output
@@ -482,40 +2111,78 @@ def get_difficulty_from_bloom_level(bloom_level):
     else:
         return "difficult"
 
-def generate_quiz(topic, difficulty_level, question_type="mcq", num_questions=5):
-    if not genai:
-        return None
-
-    try:
-        configure_google_ai()  # Ensure Google AI is configured
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        
-        # Map difficulty levels to Bloom's taxonomy levels and descriptions
-        difficulty_mapping = {
-            "beginner": {
-                "bloom_level": 1,
-                "description": "Remembering and Understanding level - basic facts, definitions, and simple concepts"
-            },
-            "intermediate": {
-                "bloom_level": 3,
-                "description": "Applying and Analyzing level - practical application and analysis of concepts"
-            },
-            "difficult": {
-                "bloom_level": 5,
-                "description": "Evaluating and Creating level - critical thinking, evaluation, and synthesis"
-            }
+# Large generation requests are split into chunks of QUIZ_GENERATION_CHUNK questions that
+# are generated in parallel, then merged and de-duplicated
+QUIZ_GENERATION_CHUNK = int(os.environ.get('QUIZ_GENERATION_CHUNK', '5'))
+
+def quiz_generation_key(topic, difficulty_level, question_type="mcq", num_questions=5):
+    return (normalize_answer_text(topic), difficulty_level, question_type, num_questions)
+
+def generate_fresh_quiz(topic, difficulty_level, question_type="mcq", num_questions=5):
+    """Generate num_questions questions, fanning large requests out as parallel chunks"""
+    chunk = max(1, QUIZ_GENERATION_CHUNK)
+    if num_questions <= chunk:
+        return generate_quiz_chunk(topic, difficulty_level, question_type, num_questions)
+
+    sizes = [chunk] * (num_questions // chunk)
+    if num_questions % chunk:
+        sizes.append(num_questions % chunk)
+    results = list(get_ai_executor().map(
+        lambda size: generate_quiz_chunk(topic, difficulty_level, question_type, size), sizes
+    ))
+
+    questions = merge_unique_questions(results)
+    missing = num_questions - len(questions)
+    if 0 < missing and questions:
+        # Chunks can overlap; one top-up request covers questions lost to de-duplication
+        questions = merge_unique_questions([questions, generate_quiz_chunk(topic, difficulty_level, question_type, missing)])
+    return questions[:num_questions] or None
+
+# Identical requests in flight at the same time (e.g. a class starting the same topic) share one
+# generation. Question bank refills call generate_fresh_quiz() directly: sharing with a live
+# request would bank copies of the questions that request just served.
+generate_quiz = single_flight(key=quiz_generation_key)(generate_fresh_quiz)
+
+def merge_unique_questions(question_lists):
+    """Concatenate question lists, dropping failed (None) lists and repeated question text"""
+    seen = set()
+    merged = []
+    for questions in question_lists:
+        for q in questions or []:
+            key = normalize_answer_text(q.get('question', ''))
+            if key and key not in seen:
+                seen.add(key)
+                merged.append(q)
+    return merged
+
+def build_quiz_prompt(topic, difficulty_level, question_type="mcq", num_questions=5):
+    """Build the Gemini prompt used to generate quiz questions"""
+    # Map difficulty levels to Bloom's taxonomy levels and descriptions
+    difficulty_mapping = {
+        "beginner": {
+            "bloom_level": 1,
+            "description": "Remembering and Understanding level - basic facts, definitions, and simple concepts"
+        },
+        "intermediate": {
+            "bloom_level": 3,
+            "description": "Applying and Analyzing level - practical application and analysis of concepts"
+        },
+        "difficult": {
+            "bloom_level": 5,
+            "description": "Evaluating and Creating level - critical thinking, evaluation, and synthesis"
         }
-        
-        difficulty_info = difficulty_mapping.get(difficulty_level, difficulty_mapping["beginner"])
-        bloom_level = difficulty_info["bloom_level"]
-        level_description = difficulty_info["description"]
-        
-        # Add randomization seed to prompt for variety
-        import random
-        random_seed = random.randint(1000, 9999)
+    }
+    
+    difficulty_info = difficulty_mapping.get(difficulty_level, difficulty_mapping["beginner"])
+    bloom_level = difficulty_info["bloom_level"]
+    level_description = difficulty_info["description"]
+    
+    # Add randomization seed to prompt for variety
+    import random
+    random_seed = random.randint(1000, 9999)
 
-        if question_type == "mcq":
-            prompt = f"""
+    if question_type == "mcq":
+        prompt = f"""
                 Generate a multiple-choice quiz on {topic} at {difficulty_level.upper()} level ({level_description}).
                 - Include exactly {num_questions} questions.
                 - Each question should have 4 answer choices.
@@ -528,8 +2195,8 @@ def generate_quiz(topic, difficulty_level, question_type="mcq", num_questions=5)
                     ...
                 ]
             """
-        elif question_type == "coding":
-            prompt = f"""
+    elif question_type == "coding":
+        prompt = f"""
 CRITICAL: You MUST generate exactly {num_questions} coding programming problems on the topic: {topic}
 
 Difficulty Level: {difficulty_level.upper()} ({level_description})
@@ -582,8 +2249,8 @@ EXAMPLE FORMAT (follow this EXACT structure):
 
 Return ONLY valid JSON array. Do NOT include any markdown code blocks, explanations, or text outside the JSON array.
             """
-        else:  # subjective
-            prompt = f"""
+    else:  # subjective
+        prompt = f"""
                 Generate subjective questions on {topic} at {difficulty_level.upper()} level ({level_description}).
                 - Include exactly {num_questions} questions.
                 - Questions should be open-ended and require detailed answers.
@@ -597,32 +2264,215 @@ Return ONLY valid JSON array. Do NOT include any markdown code blocks, explanati
                     ...
                 ]
             """
+    return prompt
+
+# ---------------------------------------------------------------------------
+# Tolerant extraction of generated questions
+#
+# Model output often wraps the JSON in prose or a code fence, leaves trailing commas, or gets
+# cut off mid-object. Rather than failing the whole generation, questions are pulled out one
+# object at a time, repaired where possible, and checked against the schema for their type.
+# ---------------------------------------------------------------------------
+def strip_trailing_commas(text):
+    """Drop commas that directly precede a closing brace or bracket (outside of strings)"""
+    out = []
+    in_string = escape = False
+    for ch in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in '}]':
+            i = len(out) - 1
+            while i >= 0 and out[i].isspace():
+                i -= 1
+            if i >= 0 and out[i] == ',':
+                del out[i]
+        out.append(ch)
+    return ''.join(out)
+
+def load_json_lenient(text):
+    """json.loads that tolerates raw newlines in strings and trailing commas; None if unparseable"""
+    try:
+        return json.loads(text, strict=False)
+    except ValueError:
+        pass
+    try:
+        return json.loads(strip_trailing_commas(text), strict=False)
+    except ValueError:
+        return None
 
-        response = model.generate_content(prompt)
+class JSONArrayStreamParser:
+    """
+    Single-pass extractor for the question objects in model output, fed text as it arrives.
+    Each top-level object is returned as soon as its closing brace is seen; surrounding prose,
+    code fences and the enclosing array are skipped. Parsing stops at the ']' that closes the
+    array holding the objects, so bracketed prose before it is ignored. finish() salvages a
+    truncated last object by cutting it back to its last comma.
+    """
 
-        if not response.text:
-            raise ValueError("Empty response from AI")
+    MAX_REPAIR_ATTEMPTS = 50
+
+    def __init__(self):
+        self.closed = False
+        self.arrays = []  # Open top-level '[' outside objects: whether each has held an object yet
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self._current = []
+        self._commas = []  # (position, open brackets) of each comma in the current object
+
+    def feed(self, text):
+        objects = []
+        for ch in text:
+            if self.closed:
+                break
+            if not self.stack:
+                if ch == '{':
+                    if self.arrays:
+                        self.arrays[-1] = True
+                    self.stack = ['{']
+                    self._current = ['{']
+                    self._commas = []
+                elif ch == '[':
+                    self.arrays.append(False)
+                elif ch == ']' and self.arrays:
+                    if self.arrays.pop():
+                        self.closed = True  # End of the question array; ignore anything after it
+                continue
+
+            self._current.append(ch)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in '{[':
+                self.stack.append(ch)
+            elif ch in '}]':
+                self.stack.pop()
+                if not self.stack:
+                    obj = load_json_lenient(''.join(self._current))
+                    if obj is None:
+                        print("Skipping unparseable question object in AI response")
+                    else:
+                        objects.append(obj)
+                    self._current = []
+            elif ch == ',':
+                self._commas.append((len(self._current) - 1, list(self.stack)))
+        return objects
+
+    def finish(self):
+        """Close off an object the output was truncated in, backing up to the last complete value"""
+        if not self.stack:
+            return []
+        text = ''.join(self._current)
+        closers = lambda stack: ''.join('}' if b == '{' else ']' for b in reversed(stack))
+        # Only cut at commas: the value before one is complete, while the tail may be a cut-off
+        # string or number ("expected_output": "10 of "100") that must not be saved as if whole
+        candidates = [text[:pos] + closers(stack) for pos, stack in reversed(self._commas[-self.MAX_REPAIR_ATTEMPTS:])]
+        self.stack, self._current, self._commas = [], [], []
+        self.in_string = self.escape = False
+        for candidate in candidates:
+            obj = load_json_lenient(candidate)
+            if obj is not None:
+                print("Recovered truncated question object from AI response")
+                return [obj]
+        return []
+
+MCQ_OPTION_PREFIX = re.compile(r'^\s*([A-Za-z])[.)]\s+')
+
+def validate_question(q, question_type):
+    """Return a cleaned copy of a generated question, or None if it doesn't fit the schema for its type"""
+    if not isinstance(q, dict):
+        return None
+    text = q.get('question')
+    if not isinstance(text, str) or not text.strip():
+        return None
+    q = dict(q)
+    q['question'] = text.strip()
+    q['type'] = question_type  # Force correct type
 
-        json_match = re.search(r"```json\n(.*)\n```", response.text, re.DOTALL)
-        if json_match:
-            questions = json.loads(json_match.group(1))
+    if question_type == 'mcq':
+        options = q.get('options')
+        if not isinstance(options, list) or len(options) < 2:
+            return None
+        if not all(isinstance(o, (str, int, float)) and str(o).strip() for o in options):
+            return None
+        # Grading compares the letter before ". " in the chosen option, so options are always "A. text"
+        bodies = [MCQ_OPTION_PREFIX.sub('', str(o)).strip() for o in options]
+        letters = [chr(ord('A') + i) for i in range(len(options))]
+        q['options'] = [f"{letter}. {body}" for letter, body in zip(letters, bodies)]
+        answer = str(q.get('answer') or '').strip()
+        prefix = MCQ_OPTION_PREFIX.match(answer + ' ')
+        if answer.upper() in letters:
+            q['answer'] = answer.upper()
+        elif prefix and prefix.group(1).upper() in letters:
+            q['answer'] = prefix.group(1).upper()
+        elif answer in bodies:
+            q['answer'] = letters[bodies.index(answer)]
         else:
-            try:
-                questions = json.loads(response.text)
-            except:
-                raise ValueError("Invalid response format from AI")
+            return None
+    elif question_type == 'coding':
+        cases = q.get('test_cases')
+        if not isinstance(cases, list):
+            return None
+        cases = [c for c in cases if isinstance(c, dict) and 'input' in c and 'expected_output' in c]
+        if not cases:
+            return None
+        q['test_cases'] = [{'input': str(c['input']), 'expected_output': str(c['expected_output']),
+                            'is_hidden': bool(c.get('is_hidden', False))} for c in cases]
+    else:
+        answer = q.get('answer', '')
+        q['answer'] = answer if isinstance(answer, str) else json.dumps(answer)
+    return q
+
+def clean_questions(objects, question_type):
+    """Validate parsed objects, unwrapping a {"questions": [...]} envelope if the model used one"""
+    questions = []
+    for obj in objects:
+        if isinstance(obj, dict) and isinstance(obj.get('questions'), list):
+            candidates = obj['questions']
+        else:
+            candidates = [obj]
+        for candidate in candidates:
+            q = validate_question(candidate, question_type)
+            if q is None:
+                print(f"Discarding generated question that doesn't match the {question_type} schema")
+            else:
+                questions.append(q)
+    return questions
 
-        # Validate that questions match the requested type
-        if questions:
-            # Ensure all questions have the correct type
-            for q in questions:
-                if 'type' not in q:
-                    q['type'] = question_type
-                elif q.get('type') != question_type:
-                    print(f"WARNING: Question type mismatch. Expected {question_type}, got {q.get('type')}")
-                    q['type'] = question_type  # Force correct type
-            
-            print(f"DEBUG: Validated {len(questions)} questions, all have type: {question_type}")
+def extract_questions(text, question_type):
+    """Recover every valid question from a complete model response"""
+    parser = JSONArrayStreamParser()
+    return clean_questions(parser.feed(text) + parser.finish(), question_type)
+
+def generate_quiz_chunk(topic, difficulty_level, question_type="mcq", num_questions=5):
+    if not genai:
+        return None
+
+    try:
+        prompt = build_quiz_prompt(topic, difficulty_level, question_type, num_questions)
+
+        response = ai_generate('quiz_generation', prompt)
+
+        if not response.text:
+            raise ValueError("Empty response from AI")
+
+        questions = extract_questions(response.text, question_type)
+        if not questions:
+            raise ValueError("No valid questions in AI response")
+        print(f"DEBUG: Validated {len(questions)} questions, all have type: {question_type}")
 
         return questions
 
@@ -630,6 +2480,137 @@ Return ONLY valid JSON array. Do NOT include any markdown code blocks, explanati
         print(f"Error in generate_quiz: {str(e)}")
         return None
 
+def generate_quiz_stream(topic, difficulty_level, question_type="mcq", num_questions=5):
+    """Yield generated questions one at a time as Gemini streams its response"""
+    parser = JSONArrayStreamParser()
+    response = ai_generate('quiz_generation_stream', build_quiz_prompt(topic, difficulty_level, question_type, num_questions), stream=True)
+    for chunk in response:
+        for q in clean_questions(parser.feed(chunk.text or ''), question_type):
+            yield q
+    for q in clean_questions(parser.finish(), question_type):
+        yield q
+
+# ---------------------------------------------------------------------------
+# Question bank for self-paced quizzes
+#
+# Questions are served from a per-(topic, difficulty, question type) bank in the database.
+# Served rows are removed so no two attempts get the same questions. Only banks with proven
+# demand are refilled: one that just served a quiz and dropped below QUESTION_BANK_LOW_WATER,
+# or a topic that missed QUESTION_BANK_MIN_MISSES times within a day (counted per process).
+# A one-off free-text topic is generated live and never banked. Rows older than
+# QUESTION_BANK_TTL_DAYS are not served and are pruned on each refill.
+# ---------------------------------------------------------------------------
+QUESTION_BANK_ENABLED = os.environ.get('QUESTION_BANK_ENABLED', 'true').lower() != 'false'
+QUESTION_BANK_LOW_WATER = int(os.environ.get('QUESTION_BANK_LOW_WATER', '10'))
+QUESTION_BANK_TARGET = int(os.environ.get('QUESTION_BANK_TARGET', '20'))
+QUESTION_BANK_BATCH = int(os.environ.get('QUESTION_BANK_BATCH', '10'))
+QUESTION_BANK_MIN_MISSES = int(os.environ.get('QUESTION_BANK_MIN_MISSES', '2'))
+QUESTION_BANK_TTL_DAYS = int(os.environ.get('QUESTION_BANK_TTL_DAYS', '14'))
+question_bank_misses = TTLCache(maxsize=4096, ttl=86400)
+_bank_refills_in_flight = set()
+_bank_refills_lock = threading.Lock()
+
+def question_bank_key(topic):
+    return normalize_answer_text(topic)[:200]
+
+def question_bank_cutoff():
+    from datetime import timedelta
+    return datetime.utcnow() - timedelta(days=QUESTION_BANK_TTL_DAYS)
+
+def take_bank_questions(topic, difficulty_level, question_type, num_questions):
+    """Remove and return num_questions banked questions, or None if the bank is short"""
+    filters = {
+        'topic_key': question_bank_key(topic),
+        'difficulty': difficulty_level,
+        'question_type': question_type,
+    }
+    for _ in range(3):
+        rows = db.session.query(QuestionBankEntry).filter_by(**filters).filter(
+            QuestionBankEntry.created_at >= question_bank_cutoff()
+        ).order_by(QuestionBankEntry.id).limit(num_questions).all()
+        if len(rows) < num_questions:
+            return None
+        ids = [row.id for row in rows]
+        questions = [json.loads(row.question_json) for row in rows]
+        # Another request may have taken some of the same rows; only keep a full claim
+        deleted = db.session.query(QuestionBankEntry).filter(QuestionBankEntry.id.in_(ids)).delete(synchronize_session=False)
+        if deleted == len(ids):
+            db.session.commit()
+            return questions
+        db.session.rollback()
+    return None
+
+def refill_question_bank(topic, difficulty_level, question_type):
+    """Generate questions until the bank reaches QUESTION_BANK_TARGET (runs in the background)"""
+    key = (question_bank_key(topic), difficulty_level, question_type)
+    try:
+        with app.app_context():
+            # Expired rows (of every bank) are never served again
+            db.session.query(QuestionBankEntry).filter(
+                QuestionBankEntry.created_at < question_bank_cutoff()
+            ).delete(synchronize_session=False)
+            db.session.commit()
+            for _ in range(max(1, QUESTION_BANK_TARGET // max(1, QUESTION_BANK_BATCH)) + 1):
+                banked = db.session.query(QuestionBankEntry).filter_by(
+                    topic_key=key[0], difficulty=difficulty_level, question_type=question_type
+                ).count()
+                if banked >= QUESTION_BANK_TARGET:
+                    break
+                questions = generate_fresh_quiz(topic, difficulty_level, question_type,
+                                                min(QUESTION_BANK_BATCH, QUESTION_BANK_TARGET - banked))
+                if not questions:
+                    break
+                for q in questions:
+                    db.session.add(QuestionBankEntry(
+                        topic_key=key[0],
+                        difficulty=difficulty_level,
+                        question_type=question_type,
+                        question_json=json.dumps(q)
+                    ))
+                db.session.commit()
+    except Exception as e:
+        print(f"Question bank refill failed for {key}: {e}")
+    finally:
+        with _bank_refills_lock:
+            _bank_refills_in_flight.discard(key)
+
+def schedule_bank_refill(topic, difficulty_level, question_type):
+    """Queue a background refill unless one is already running for this bank"""
+    key = (question_bank_key(topic), difficulty_level, question_type)
+    with _bank_refills_lock:
+        if key in _bank_refills_in_flight:
+            return
+        _bank_refills_in_flight.add(key)
+    get_background_executor().submit(refill_question_bank, topic, difficulty_level, question_type)
+
+def get_quiz_questions(topic, difficulty_level, question_type="mcq", num_questions=5):
+    """Questions for a self-paced quiz: from the bank when possible, otherwise generated live"""
+    if not QUESTION_BANK_ENABLED:
+        return generate_quiz(topic, difficulty_level, question_type, num_questions)
+
+    questions = None
+    try:
+        questions = take_bank_questions(topic, difficulty_level, question_type, num_questions)
+        if questions:
+            remaining = db.session.query(QuestionBankEntry).filter_by(
+                topic_key=question_bank_key(topic), difficulty=difficulty_level, question_type=question_type
+            ).filter(QuestionBankEntry.created_at >= question_bank_cutoff()).count()
+            if remaining < QUESTION_BANK_LOW_WATER:
+                schedule_bank_refill(topic, difficulty_level, question_type)
+        else:
+            bank = (question_bank_key(topic), difficulty_level, question_type)
+            misses = (question_bank_misses.get(bank) or 0) + 1
+            question_bank_misses.set(bank, misses)
+            if misses >= QUESTION_BANK_MIN_MISSES:
+                schedule_bank_refill(topic, difficulty_level, question_type)
+    except Exception as e:
+        db.session.rollback()
+        print(f"Question bank lookup failed: {e}")
+
+    if questions:
+        return questions
+    return generate_quiz(topic, difficulty_level, question_type, num_questions)
+
 def process_document(file_path):
     """Process uploaded document to extract content - SIMPLIFIED FOR VERCEL"""
     try:
@@ -797,10 +2778,258 @@ def process_document(file_path):
             return " ".join(words).strip()[:100]
 
     except Exception as e:
-        print(f"Error processing document: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        print(f"Error processing document: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+# ---------------------------------------------------------------------------
+# Shared quiz grading
+#
+# Submissions are stored ungraded and a GradingJob row is queued. GRADING_WORKERS
+# background threads claim queued jobs and grade them; with GRADING_WORKERS=0 (the
+# default on Vercel, where threads do not outlive the request) jobs stay queued for
+# the /tasks/grading/run cron (see vercel.json; authorised by CRON_SECRET or
+# GRADING_TASK_TOKEN). Vercel only runs a per-minute cron on paid plans; when nothing
+# drains the queue, dispatch logs it and the results page warns the teacher about jobs
+# queued longer than GRADING_STALE_SECONDS. A job that fails GRADING_MAX_ATTEMPTS times
+# marks its submission 'failed', and the teacher can queue it again from the results page.
+# ---------------------------------------------------------------------------
+GRADING_WORKERS = int(os.environ.get('GRADING_WORKERS', '0' if os.environ.get('VERCEL') else '2'))
+GRADING_MAX_ATTEMPTS = int(os.environ.get('GRADING_MAX_ATTEMPTS', '3'))
+GRADING_POLL_INTERVAL = float(os.environ.get('GRADING_POLL_INTERVAL', '5'))
+GRADING_JOB_TIMEOUT = int(os.environ.get('GRADING_JOB_TIMEOUT', '900'))  # requeue 'running' jobs older than this
+GRADING_STALE_SECONDS = int(os.environ.get('GRADING_STALE_SECONDS', '600'))
+# /tasks/grading/run stops claiming jobs after this long; keep one job's worth of headroom
+# under the serverless function's maxDuration
+GRADING_TASK_BUDGET_SECONDS = float(os.environ.get('GRADING_TASK_BUDGET_SECONDS', '20'))
+_grading_wakeup = threading.Event()
+_grading_threads = []
+_grading_threads_lock = threading.Lock()
+
+def grade_answer(question, answer, ai_score=None):
+    """
+    Score one stored QuizAnswer in place and return the marks gained (safe to repeat).
+    For subjective questions ai_score may be passed in when it was already batch-evaluated.
+    """
+    user_ans = (answer.user_answer or '').strip()
+    marks = float(question.marks or 1)
+    gained = 0.0
+
+    if question.qtype == 'mcq':
+        answer.is_correct = (user_ans.split('. ')[0] == (question.answer or '')) if user_ans else False
+        gained = marks if answer.is_correct else 0.0
+    elif question.qtype == 'coding':
+        if user_ans:
+            language = answer.code_language or 'python'
+            try:
+                test_cases = json.loads(question.test_cases_json) if question.test_cases_json else []
+                test_results = run_test_cases(user_ans, language, test_cases,
+                                              question.time_limit_seconds or 2, question.memory_limit_mb or 256)
+                percentage_passed = test_results['percentage'] / 100.0
+                gained = marks * percentage_passed
+                answer.is_correct = percentage_passed == 1.0  # Perfect score
+                answer.passed_test_cases = test_results['passed']
+                answer.total_test_cases = test_results['total']
+                answer.test_results_json = json.dumps(test_results['results'])
+            except Exception as e:
+                print(f"Error evaluating coding question: {e}")
+                answer.is_correct = False
+                answer.test_results_json = json.dumps([])
+            answer.code_language = language
+    else:
+        # subjective via AI
+        if user_ans:
+            if ai_score is None:
+                ai_score = evaluate_subjective_answers([(question.question, user_ans, question.answer or '')])[0]
+            answer.ai_score = ai_score
+            gained = marks * float(answer.ai_score or 0.0)
+            answer.is_correct = (answer.ai_score or 0.0) >= 0.6
+        else:
+            answer.ai_score = 0.0
+            answer.is_correct = False
+
+    answer.scored_marks = gained
+    return gained
+
+def grade_submission(submission_id):
+    """
+    Grade every stored answer of a submission and write the final score.
+    Grading works only from persisted answers, so running it twice gives the same result.
+    """
+    submission = db.session.get(QuizSubmission, submission_id)
+    if not submission:
+        return None
+    questions = db.session.query(QuizQuestion).filter_by(quiz_id=submission.quiz_id).all()
+    answers = {a.question_id: a for a in db.session.query(QuizAnswer).filter_by(submission_id=submission.id).all()}
+
+    # Score all subjective answers together before grading question by question
+    subjective = [(q, answers[q.id]) for q in questions if q.qtype not in ('mcq', 'coding') and q.id in answers]
+    ai_scores = evaluate_subjective_answers(
+        [(q.question, (ans.user_answer or '').strip(), q.answer or '') for q, ans in subjective]
+    )
+    ai_score_map = {q.id: score for (q, _), score in zip(subjective, ai_scores)}
+
+    total_marks = 0.0
+    scored_marks = 0.0
+    for q in questions:
+        total_marks += float(q.marks or 1)
+        ans = answers.get(q.id)
+        if ans is not None:
+            scored_marks += grade_answer(q, ans, ai_score_map.get(q.id))
+
+    submission.score = scored_marks
+    submission.total = total_marks
+    submission.percentage = (scored_marks / total_marks) * 100 if total_marks > 0 else 0
+    submission.passed = submission.percentage >= 60
+    submission.grading_status = 'graded'
+    db.session.commit()
+    return submission
+
+def enqueue_grading(submission):
+    """Mark a submission pending and queue it for grading (caller commits)"""
+    submission.grading_status = 'pending'
+    job = GradingJob(submission_id=submission.id)
+    db.session.add(job)
+    return job
+
+def claim_grading_job(job_id=None):
+    """Atomically move one queued job (or the given one) to 'running'; returns it or None"""
+    now = datetime.utcnow()
+    # Jobs left 'running' by a worker that died go back to the queue
+    from datetime import timedelta
+    db.session.query(GradingJob).filter(
+        GradingJob.status == 'running',
+        GradingJob.updated_at < now - timedelta(seconds=GRADING_JOB_TIMEOUT)
+    ).update({'status': 'queued'}, synchronize_session=False)
+
+    for _ in range(5):
+        query = db.session.query(GradingJob).filter_by(status='queued')
+        if job_id is not None:
+            query = query.filter_by(id=job_id)
+        job = query.order_by(GradingJob.id).first()
+        if not job:
+            db.session.commit()
+            return None
+        claimed = db.session.query(GradingJob).filter_by(id=job.id, status='queued').update(
+            {'status': 'running', 'attempts': GradingJob.attempts + 1, 'updated_at': now},
+            synchronize_session=False
+        )
+        db.session.commit()
+        if claimed:
+            db.session.refresh(job)
+            return job
+    return None
+
+def process_grading_job(job_id=None):
+    """Claim and run one grading job; returns False when nothing was queued"""
+    job = claim_grading_job(job_id)
+    if job is None:
+        return False
+    try:
+        grade_submission(job.submission_id)
+        job.status = 'done'
+        job.last_error = None
+    except Exception as e:
+        db.session.rollback()
+        print(f"Grading job {job.id} failed: {e}")
+        job = db.session.get(GradingJob, job.id)
+        job.status = 'queued' if (job.attempts or 0) < GRADING_MAX_ATTEMPTS else 'failed'
+        job.last_error = str(e)
+        if job.status == 'failed':
+            submission = db.session.get(QuizSubmission, job.submission_id)
+            if submission is not None:
+                submission.grading_status = 'failed'
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+    return True
+
+def grading_worker_loop():
+    while True:
+        try:
+            with app.app_context():
+                processed = process_grading_job()
+        except Exception as e:
+            print(f"Grading worker error: {e}", file=sys.stderr)
+            processed = False
+        if not processed:
+            _grading_wakeup.wait(GRADING_POLL_INTERVAL)
+            _grading_wakeup.clear()
+
+def start_grading_workers():
+    """Start the background grading threads once per process"""
+    with _grading_threads_lock:
+        while len(_grading_threads) < GRADING_WORKERS:
+            worker = threading.Thread(target=grading_worker_loop, name=f'grader-{len(_grading_threads)}', daemon=True)
+            worker.start()
+            _grading_threads.append(worker)
+
+def dispatch_grading(job):
+    """Wake the workers for a committed job; without workers it waits for the cron drain"""
+    if GRADING_WORKERS > 0:
+        start_grading_workers()
+        _grading_wakeup.set()
+    elif not (os.environ.get('CRON_SECRET') or os.environ.get('GRADING_TASK_TOKEN')):
+        print(f"Grading job {job.id} queued but nothing drains the queue: set GRADING_WORKERS, "
+              "or CRON_SECRET/GRADING_TASK_TOKEN and schedule /tasks/grading/run", file=sys.stderr)
+
+def count_stale_grading_jobs(quiz_id):
+    """Jobs of this quiz still queued after GRADING_STALE_SECONDS, i.e. nothing is draining the queue"""
+    from datetime import timedelta
+    return db.session.query(GradingJob.id).join(
+        QuizSubmission, QuizSubmission.id == GradingJob.submission_id
+    ).filter(
+        QuizSubmission.quiz_id == quiz_id, GradingJob.status == 'queued',
+        GradingJob.created_at < datetime.utcnow() - timedelta(seconds=GRADING_STALE_SECONDS)
+    ).count()
+
+# Server-side quiz attempt store. Generated questions (with coding test cases and starter
+# code) used to ride along in the cookie session; now only '<kind>_id' does, and the
+# payload lives in quiz_attempt for QUIZ_ATTEMPT_TTL_HOURS.
+QUIZ_ATTEMPT_TTL_HOURS = int(os.environ.get('QUIZ_ATTEMPT_TTL_HOURS', '24'))
+_quiz_attempt_writes = 0
+
+def save_quiz_attempt(kind, data):
+    """Store data as the current user's attempt of this kind, replacing the previous one"""
+    global _quiz_attempt_writes
+    from datetime import timedelta
+    session.pop(kind, None)  # Drop any payload left in an old-style session cookie
+    previous_id = session.pop(f'{kind}_id', None)
+    if previous_id:
+        db.session.query(QuizAttempt).filter_by(id=previous_id, user_id=current_user.id).delete(synchronize_session=False)
+    attempt = QuizAttempt(
+        id=secrets.token_hex(16),
+        user_id=current_user.id,
+        kind=kind,
+        data_json=json.dumps(data),
+        expires_at=datetime.utcnow() + timedelta(hours=QUIZ_ATTEMPT_TTL_HOURS)
+    )
+    db.session.add(attempt)
+    _quiz_attempt_writes += 1
+    if _quiz_attempt_writes >= 200:
+        _quiz_attempt_writes = 0
+        db.session.query(QuizAttempt).filter(QuizAttempt.expires_at < datetime.utcnow()).delete(synchronize_session=False)
+    db.session.commit()
+    session[f'{kind}_id'] = attempt.id
+
+def load_quiz_attempt(kind):
+    """Return the current user's unexpired attempt data of this kind, or None"""
+    attempt_id = session.get(f'{kind}_id')
+    if not attempt_id:
         return None
+    attempt = db.session.query(QuizAttempt).filter(
+        QuizAttempt.id == attempt_id,
+        QuizAttempt.user_id == current_user.id,
+        QuizAttempt.kind == kind,
+        QuizAttempt.expires_at > datetime.utcnow()
+    ).first()
+    return json.loads(attempt.data_json) if attempt else None
+
+def discard_quiz_attempt(kind):
+    attempt_id = session.pop(f'{kind}_id', None)
+    if attempt_id:
+        db.session.query(QuizAttempt).filter_by(id=attempt_id, user_id=current_user.id).delete(synchronize_session=False)
+        db.session.commit()
 
 # Routes
 @app.route('/')
@@ -860,6 +3089,34 @@ def health_check():
             'type': type(e).__name__
         }), 500
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def add_server_timing(response):
+    """Report total and AI time for the request in a Server-Timing header"""
+    started = g.get('request_started')
+    if started is not None:
+        timings = [f"app;dur={(time.perf_counter() - started) * 1000:.1f}"]
+        if g.get('ai_calls'):
+            timings.append(f'ai;dur={g.ai_seconds * 1000:.1f};desc="{g.ai_calls} calls"')
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+# Prometheus scrape endpoint, off unless METRICS_TOKEN is set. Scrapers send
+# "Authorization: Bearer <token>"; logged-in teachers can also open it in the browser.
+@app.route('/metrics')
+def metrics():
+    metrics_token = os.environ.get('METRICS_TOKEN')
+    if not metrics_token:
+        return jsonify({'error': 'Not found'}), 404
+    authorized = secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {metrics_token}') or (
+        current_user.is_authenticated and current_user.role == 'teacher')
+    if not authorized:
+        return jsonify({'error': 'Not found'}), 404
+    return Response(ai_metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/init-db')
 def init_database():
     """Initialize database tables for Vercel deployment"""
@@ -867,6 +3124,7 @@ def init_database():
         with app.app_context():
             # Create all tables
             db.create_all()
+            run_schema_migrations()
             
             # Fix password_hash column size if needed
             try:
@@ -1078,6 +3336,18 @@ def run_test_cases_api():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/judge0/callback', methods=['PUT', 'POST'])
+def judge0_callback():
+    """Judge0 completion callback (set JUDGE0_CALLBACK_URL to this route)"""
+    data = request.get_json(silent=True) or {}
+    token = data.get('token')
+    with _judge0_waiters_lock:
+        waiter = _judge0_waiters.get(token)
+        if waiter is not None:
+            _judge0_callback_results[token] = data
+            waiter.set()
+    return ('', 204)
+
 @app.route('/google77cd707098d48f23.html')
 def google_verification():
     return send_file('static/google77cd707098d48f23.html', mimetype='text/html')
@@ -1239,6 +3509,7 @@ def teacher_create_quiz():
                 db.session.add(qq)
 
             db.session.commit()
+            build_quiz_payload(quiz)
             flash(f'Quiz created! Share code: {code}', 'success')
             return redirect(url_for('dashboard'))
         except Exception as e:
@@ -1302,7 +3573,7 @@ def teacher_create_quiz_simple():
                 q['marks'] = marks
 
             # Store in session for preview
-            session['preview_quiz'] = {
+            preview = {
                 'title': title,
                 'topic': topic,
                 'difficulty': difficulty,
@@ -1310,7 +3581,8 @@ def teacher_create_quiz_simple():
                 'question_type': question_type,
                 'questions': questions
             }
-            return render_template('preview_quiz.html', data=session['preview_quiz'])
+            save_quiz_attempt('preview_quiz', preview)
+            return render_template('preview_quiz.html', data=preview)
         except Exception as e:
             db.session.rollback()
             print(f"Error creating simple quiz: {str(e)}")
@@ -1353,7 +3625,7 @@ def teacher_quiz_preview():
             q['marks'] = marks
 
         # Store in session for finalize
-        session['preview_quiz'] = {
+        preview = {
             'title': title or f"{topic} Quiz",
             'topic': topic,
             'difficulty': difficulty,
@@ -1361,19 +3633,118 @@ def teacher_quiz_preview():
             'question_type': question_type,
             'questions': questions
         }
-        return render_template('preview_quiz.html', data=session['preview_quiz'])
+        save_quiz_attempt('preview_quiz', preview)
+        return render_template('preview_quiz.html', data=preview)
     except Exception as e:
         print(f"Preview error: {e}")
         flash('Error preparing preview.', 'error')
         return redirect(url_for('teacher_create_quiz_simple'))
 
+# Limits for the streaming quiz form (matching create_quiz_simple.html's inputs; count up to the stream cap)
+STREAM_QUIZ_MAX_COUNT = 50
+STREAM_QUIZ_MAX_MARKS = 100
+STREAM_QUIZ_MAX_DURATION = 300
+
+def parse_stream_quiz_args(args):
+    """(count, marks, duration_minutes) from the query string, clamped; ValueError if not whole numbers"""
+    count = int(args.get('count', '0') or 0)
+    marks = max(1, min(int(args.get('marks', '1') or 1), STREAM_QUIZ_MAX_MARKS))
+    duration = args.get('duration', '').strip()
+    duration_minutes = max(1, min(int(duration), STREAM_QUIZ_MAX_DURATION)) if duration else None
+    return min(count, STREAM_QUIZ_MAX_COUNT), marks, duration_minutes
+
+# Streaming preview: questions are pushed to the page (server-sent events) as they are generated
+@app.route('/teacher/quiz/preview/stream')
+@login_required
+def teacher_quiz_preview_stream():
+    guard = require_teacher()
+    if guard:
+        return guard
+    topic = request.args.get('topic', '').strip()
+    try:
+        count, marks, duration_minutes = parse_stream_quiz_args(request.args)
+    except ValueError:
+        flash('Number of questions, marks and duration must be whole numbers.', 'error')
+        return redirect(url_for('teacher_create_quiz_simple'))
+    if not topic or count <= 0:
+        flash('Provide topic and number of questions.', 'error')
+        return redirect(url_for('teacher_create_quiz_simple'))
+    data = {
+        'title': request.args.get('title', '').strip() or f"{topic} Quiz",
+        'topic': topic,
+        'count': count,
+        'difficulty': request.args.get('difficulty', 'beginner').strip(),
+        'duration_minutes': duration_minutes,
+        'question_type': request.args.get('question_type', 'mcq').strip(),
+        'marks': marks
+    }
+    return render_template('preview_quiz_stream.html', data=data)
+
+@app.route('/teacher/quiz/generate_stream')
+@login_required
+def teacher_quiz_generate_stream():
+    guard = require_teacher()
+    if guard:
+        return guard
+    topic = request.args.get('topic', '').strip()
+    try:
+        count, marks, _ = parse_stream_quiz_args(request.args)
+        bad_args = None
+    except ValueError:
+        count, marks, bad_args = 0, 1, 'Number of questions, marks and duration must be whole numbers.'
+    difficulty = request.args.get('difficulty', 'beginner').strip()
+    difficulty = difficulty if difficulty in ['beginner','intermediate','advanced'] else 'beginner'
+    question_type = request.args.get('question_type', 'mcq').strip()
+
+    def events():
+        if bad_args:
+            yield f"event: failed\ndata: {json.dumps({'error': bad_args})}\n\n"
+            return
+        sent = 0
+        try:
+            if topic and count > 0:
+                for q in generate_quiz_stream(topic, difficulty, question_type, count):
+                    q['marks'] = marks
+                    yield f"event: question\ndata: {json.dumps(q)}\n\n"
+                    sent += 1
+                    if sent >= count:
+                        break
+                if sent == 0:
+                    # Nothing parseable came through the stream; fall back to a regular generation
+                    for q in generate_quiz(topic, difficulty, question_type, count) or []:
+                        q['marks'] = marks
+                        yield f"event: question\ndata: {json.dumps(q)}\n\n"
+                        sent += 1
+        except Exception as e:
+            print(f"Streaming generation error: {e}")
+        if sent:
+            yield f"event: done\ndata: {json.dumps({'count': sent})}\n\n"
+        else:
+            yield f"event: failed\ndata: {json.dumps({'error': 'Failed to generate questions. Try again.'})}\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/teacher/quiz/finalize', methods=['POST'])
 @login_required
 def teacher_quiz_finalize():
     guard = require_teacher()
     if guard:
         return guard
-    data = session.get('preview_quiz')
+    data = load_quiz_attempt('preview_quiz')
+    streamed_questions = request.form.get('questions_json')
+    if streamed_questions:
+        # Streaming preview posts the generated questions back with the form
+        duration = request.form.get('duration_minutes', '').strip()
+        try:
+            data = {
+                'title': request.form.get('title', '').strip() or 'Quiz',
+                'difficulty': request.form.get('difficulty', 'beginner').strip(),
+                'duration_minutes': int(duration) if duration else None,
+                'questions': json.loads(streamed_questions)
+            }
+        except Exception:
+            data = None
     if not data:
         flash('No quiz in preview.', 'error')
         return redirect(url_for('teacher_create_quiz_simple'))
@@ -1435,7 +3806,8 @@ def teacher_quiz_finalize():
             db.session.add(qq)
 
         db.session.commit()
-        session.pop('preview_quiz', None)
+        build_quiz_payload(quiz)
+        discard_quiz_attempt('preview_quiz')
         flash(f'Quiz created! Share code: {code}', 'success')
         return redirect(url_for('dashboard'))
     except Exception as e:
@@ -1447,20 +3819,163 @@ def teacher_quiz_finalize():
         flash(f'Error finalizing quiz: {str(e)}', 'error')
         return redirect(url_for('teacher_create_quiz_simple'))
 
+# ---------------------------------------------------------------------------
+# Exam-start mode
+#
+# When a whole class opens the same code at once, the teacher can start exam mode: the compiled
+# payload is warmed and students wait in a lobby that admits them at admit_per_minute. Each
+# student's submission row is created when they enter the lobby, so the inserts are spread over
+# the wait and students who never join leave nothing in the results. Each arrival is given an admission time at a
+# steady pace (the first EXAM_LOBBY_BURST go straight in). The time is kept in the signed
+# session, so any worker can check it. Each worker paces its own share of the rate.
+# ---------------------------------------------------------------------------
+EXAM_LOBBY_BURST = int(os.environ.get('EXAM_LOBBY_BURST', '25'))
+EXAM_LOBBY_WORKERS = int(os.environ.get('EXAM_LOBBY_WORKERS', os.environ.get('WEB_CONCURRENCY', '1')))
+exam_state_memory = TTLCache(maxsize=1024, ttl=5)
+
+class ExamLobby:
+    """Hands out admission times spaced 1/rate apart, letting the first burst through immediately"""
+
+    def __init__(self, per_second, burst=EXAM_LOBBY_BURST):
+        self.interval = 1.0 / max(per_second, 0.001)
+        self.burst_window = max(burst - 1, 0) * self.interval
+        self.next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def admit_at(self):
+        with self._lock:
+            now = time.time()
+            self.next_slot = max(self.next_slot, now)
+            slot = self.next_slot - self.burst_window
+            self.next_slot += self.interval
+        return max(slot, now)
+
+_exam_lobbies = {}
+_exam_lobbies_lock = threading.Lock()
+
+def get_exam_lobby(quiz_id, admit_per_minute):
+    per_second = admit_per_minute / 60.0 / max(1, EXAM_LOBBY_WORKERS)
+    with _exam_lobbies_lock:
+        lobby = _exam_lobbies.get(quiz_id)
+        if lobby is None or lobby.interval != 1.0 / max(per_second, 0.001):
+            lobby = _exam_lobbies[quiz_id] = ExamLobby(per_second)
+        return lobby
+
+def get_exam_state(code):
+    """(quiz_id, admit_per_minute or None when exam mode is off) for a code, cached for a few seconds"""
+    code = code.upper()
+    state = exam_state_memory.get(code)
+    if state is None:
+        row = db.session.query(Quiz.id, ExamSession.admit_per_minute).outerjoin(
+            ExamSession, db.and_(ExamSession.quiz_id == Quiz.id, ExamSession.active.is_(True))
+        ).filter(Quiz.code == code).first()
+        state = (row[0], row[1]) if row else (None, None)
+        exam_state_memory.set(code, state)
+    return state
+
+def exam_admitted(quiz_id):
+    admit_at = session.get(f'exam_admit_{quiz_id}')
+    return admit_at is not None and admit_at <= time.time()
+
+def open_exam_submission(quiz_id):
+    """Create the student's open submission on entering the lobby, unless they already have one"""
+    if db.session.query(QuizSubmission.id).filter_by(quiz_id=quiz_id, student_id=current_user.id).first():
+        return
+    quiz = db.session.get(Quiz, quiz_id)
+    db.session.add(QuizSubmission(quiz_id=quiz_id, student_id=current_user.id,
+                                  question_count=len(get_quiz_payload(quiz)['questions'])))
+    db.session.commit()
+
+# Teacher: start exam mode (warm the quiz payload, open the lobby)
+@app.route('/teacher/quiz/<code>/exam/start', methods=['POST'])
+@login_required
+def teacher_start_exam(code):
+    guard = require_teacher()
+    if guard:
+        return guard
+    quiz = db.session.query(Quiz).filter_by(code=code.upper(), created_by=current_user.id).first()
+    if not quiz:
+        flash('Quiz not found or you do not have permission', 'error')
+        return redirect(url_for('dashboard'))
+    try:
+        admit_per_minute = max(1, int(request.form.get('admit_per_minute', '120') or 120))
+        get_quiz_payload(quiz)
+        exam = db.session.get(ExamSession, quiz.id) or ExamSession(quiz_id=quiz.id)
+        exam.admit_per_minute = admit_per_minute
+        exam.active = True
+        exam.started_at = datetime.utcnow()
+        db.session.add(exam)
+        db.session.commit()
+        exam_state_memory.delete(quiz.code)
+        flash(f'Exam mode on: students are admitted at {admit_per_minute}/min.', 'success')
+    except Exception as e:
+        db.session.rollback()
+        print(f"Start exam error: {e}")
+        flash('Could not start exam mode.', 'error')
+    return redirect(url_for('teacher_quiz_results', code=quiz.code))
+
+@app.route('/teacher/quiz/<code>/exam/stop', methods=['POST'])
+@login_required
+def teacher_stop_exam(code):
+    guard = require_teacher()
+    if guard:
+        return guard
+    quiz = db.session.query(Quiz).filter_by(code=code.upper(), created_by=current_user.id).first()
+    if not quiz:
+        flash('Quiz not found or you do not have permission', 'error')
+        return redirect(url_for('dashboard'))
+    exam = db.session.get(ExamSession, quiz.id)
+    if exam:
+        exam.active = False
+        db.session.commit()
+    exam_state_memory.delete(quiz.code)
+    flash('Exam mode off: students go straight to the quiz.', 'success')
+    return redirect(url_for('teacher_quiz_results', code=quiz.code))
+
+# Student: exam lobby (waiting room) and its polling endpoint
+@app.route('/quiz/lobby/<code>')
+@login_required
+def exam_lobby(code):
+    quiz_id, admit_per_minute = get_exam_state(code)
+    if not quiz_id:
+        flash('Quiz not found', 'error')
+        return redirect(url_for('join_quiz'))
+    if admit_per_minute is None or exam_admitted(quiz_id):
+        return redirect(url_for('take_shared_quiz', code=code.upper()))
+    key = f'exam_admit_{quiz_id}'
+    if key not in session:
+        open_exam_submission(quiz_id)
+        session[key] = get_exam_lobby(quiz_id, admit_per_minute).admit_at()
+    return render_template('exam_lobby.html', code=code.upper(), wait_seconds=max(0.0, session[key] - time.time()))
+
+@app.route('/quiz/lobby/<code>/status')
+@login_required
+def exam_lobby_status(code):
+    quiz_id, admit_per_minute = get_exam_state(code)
+    if not quiz_id:
+        return jsonify({'error': 'Quiz not found'}), 404
+    take_url = url_for('take_shared_quiz', code=code.upper())
+    admit_at = session.get(f'exam_admit_{quiz_id}')
+    if admit_per_minute is None or (admit_at is not None and admit_at <= time.time()):
+        return jsonify({'admitted': True, 'url': take_url})
+    if admit_at is None:
+        return jsonify({'admitted': False, 'url': url_for('exam_lobby', code=code.upper())})
+    return jsonify({'admitted': False, 'wait_seconds': round(admit_at - time.time(), 1)})
+
 # Student: join quiz by code
 @app.route('/quiz/join', methods=['GET', 'POST'])
 @login_required
 def join_quiz():
     if request.method == 'POST':
         code = request.form.get('code', '').strip().upper()
-        quiz = db.session.query(Quiz).filter_by(code=code).first()
-        if not quiz:
+        quiz_id, admit_per_minute = get_exam_state(code)
+        if not quiz_id:
             flash('Invalid quiz code', 'error')
             return redirect(url_for('join_quiz'))
         
         # Check if student has already completed this quiz
-        existing_completed = db.session.query(QuizSubmission).filter_by(
-            quiz_id=quiz.id, 
+        existing_completed = db.session.query(QuizSubmission.id).filter_by(
+            quiz_id=quiz_id, 
             student_id=current_user.id, 
             completed=True
         ).first()
@@ -1469,181 +3984,310 @@ def join_quiz():
             flash('You have already attempted this quiz. You can only take it once.', 'error')
             return redirect(url_for('dashboard'))
         
+        if admit_per_minute is not None:
+            return redirect(url_for('exam_lobby', code=code))
         return redirect(url_for('take_shared_quiz', code=code))
     return render_template('join_quiz.html')
 
+# ---------------------------------------------------------------------------
+# Compiled quiz payloads
+#
+# A finalized shared quiz doesn't change, so its question list is parsed once (options,
+# test cases, language constraints and starter code decoded from JSON) and stored in
+# quiz_payload, tagged with Quiz.content_version. Each process keeps hot payloads in memory,
+# so a class starting an exam together costs one cache lookup per student. Questions can't be
+# edited once a quiz is finalized; an edit path added later must bump Quiz.content_version.
+# ---------------------------------------------------------------------------
+QUIZ_PAYLOAD_CACHE_SIZE = int(os.environ.get('QUIZ_PAYLOAD_CACHE_SIZE', '256'))
+quiz_payload_memory = TTLCache(maxsize=QUIZ_PAYLOAD_CACHE_SIZE, ttl=3600)
+quiz_payload_flight = SingleFlight()
+
+def compile_quiz_question(q):
+    """Question dict as the take-quiz page expects it (never includes the answer key)"""
+    try:
+        options = json.loads(q.options_json) if q.options_json else []
+    except Exception:
+        options = []
+
+    question_data = {
+        'id': q.id,
+        'question': q.question,
+        'qtype': q.qtype,
+        'marks': q.marks,
+        'options': options,
+    }
+
+    # Add coding question data
+    if q.qtype == 'coding':
+        try:
+            question_data['test_cases'] = json.loads(q.test_cases_json) if q.test_cases_json else []
+            question_data['language_constraints'] = json.loads(q.language_constraints) if q.language_constraints else ['python', 'java', 'cpp', 'c']
+            question_data['time_limit_seconds'] = q.time_limit_seconds or 2
+            question_data['memory_limit_mb'] = q.memory_limit_mb or 256
+            question_data['sample_input'] = q.sample_input or ''
+            question_data['sample_output'] = q.sample_output or ''
+            question_data['starter_code'] = json.loads(q.starter_code) if q.starter_code else {}
+        except Exception as e:
+            print(f"Error parsing coding question data: {e}")
+            question_data['test_cases'] = []
+            question_data['language_constraints'] = ['python', 'java', 'cpp', 'c']
+    return question_data
+
+def build_quiz_payload(quiz):
+    """Compile the quiz's questions and store the result for its current content_version"""
+    version = quiz.content_version or 1
+    q_rows = db.session.query(QuizQuestion).filter_by(quiz_id=quiz.id).order_by(QuizQuestion.id).all()
+    payload = {'quiz_id': quiz.id, 'version': version, 'questions': [compile_quiz_question(q) for q in q_rows]}
+    try:
+        db.session.merge(QuizPayload(quiz_id=quiz.id, version=version, payload_json=json.dumps(payload),
+                                     built_at=datetime.utcnow()))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Storing compiled payload for quiz {quiz.id} failed: {e}")
+    quiz_payload_memory.set((quiz.id, version), payload)
+    return payload
+
+def get_quiz_payload(quiz):
+    """
+    Parsed question list for a shared quiz: memory, then quiz_payload, then a fresh build.
+    The returned dict is shared between requests and must not be modified.
+    """
+    version = quiz.content_version or 1
+    payload = quiz_payload_memory.get((quiz.id, version))
+    if payload is not None:
+        return payload
+    # A class opening a cold quiz together loads (or builds) it once
+    return quiz_payload_flight.do((quiz.id, version), load_quiz_payload, quiz, version)
+
+def load_quiz_payload(quiz, version):
+    stored = db.session.get(QuizPayload, quiz.id)
+    if stored is not None and stored.version == version:
+        payload = json.loads(stored.payload_json)
+        quiz_payload_memory.set((quiz.id, version), payload)
+        return payload
+    return build_quiz_payload(quiz)
+
 # Take shared quiz
 @app.route('/quiz/take/<code>')
 @login_required
 def take_shared_quiz(code):
-    quiz = db.session.query(Quiz).filter_by(code=code.upper()).first()
+    # In exam mode students enter through the lobby
+    quiz_id, admit_per_minute = get_exam_state(code)
+    if admit_per_minute is not None and not exam_admitted(quiz_id):
+        return redirect(url_for('exam_lobby', code=code.upper()))
+    quiz, existing, already_completed = find_quiz_submission(code, current_user.id)
     if not quiz:
         flash('Quiz not found', 'error')
         return redirect(url_for('join_quiz'))
     
     # Check if student has already completed this quiz
-    existing_completed = db.session.query(QuizSubmission).filter_by(
-        quiz_id=quiz.id, 
-        student_id=current_user.id, 
-        completed=True
-    ).first()
-    
-    if existing_completed:
+    if already_completed:
         flash('You have already attempted this quiz. You can only take it once.', 'error')
         return redirect(url_for('dashboard'))
     
-    q_rows = db.session.query(QuizQuestion).filter_by(quiz_id=quiz.id).all()
-    # Parse options JSON server-side to avoid template errors
-    parsed_questions = []
-    for q in q_rows:
-        try:
-            options = json.loads(q.options_json) if q.options_json else []
-        except Exception:
-            options = []
-        
-        question_data = {
-            'id': q.id,
-            'question': q.question,
-            'qtype': q.qtype,
-            'marks': q.marks,
-            'options': options,
-        }
-        
-        # Add coding question data
-        if q.qtype == 'coding':
-            try:
-                question_data['test_cases'] = json.loads(q.test_cases_json) if q.test_cases_json else []
-                question_data['language_constraints'] = json.loads(q.language_constraints) if q.language_constraints else ['python', 'java', 'cpp', 'c']
-                question_data['time_limit_seconds'] = q.time_limit_seconds or 2
-                question_data['memory_limit_mb'] = q.memory_limit_mb or 256
-                question_data['sample_input'] = q.sample_input or ''
-                question_data['sample_output'] = q.sample_output or ''
-                question_data['starter_code'] = json.loads(q.starter_code) if q.starter_code else {}
-            except Exception as e:
-                print(f"Error parsing coding question data: {e}")
-                question_data['test_cases'] = []
-                question_data['language_constraints'] = ['python', 'java', 'cpp', 'c']
-        
-        parsed_questions.append(question_data)
+    parsed_questions = get_quiz_payload(quiz)['questions']
     # Ensure a started submission exists (one per student/quiz if not completed)
-    existing = db.session.query(QuizSubmission).filter_by(quiz_id=quiz.id, student_id=current_user.id, completed=False).first()
+    saved_answers = {}
     if not existing:
-        existing = QuizSubmission(quiz_id=quiz.id, student_id=current_user.id, question_count=len(q_rows))
+        existing = QuizSubmission(quiz_id=quiz.id, student_id=current_user.id, question_count=len(parsed_questions))
         db.session.add(existing)
         db.session.commit()
-    return render_template('take_shared_quiz.html', quiz=quiz, questions=parsed_questions)
+    else:
+        # Restore autosaved answers after a reload or reconnect
+        saved_answers = {row.question_id: {'answer': row.user_answer or '', 'language': row.code_language,
+                                           'version': row.client_version or 0}
+                         for row in db.session.query(QuizAnswer.question_id, QuizAnswer.user_answer,
+                                                     QuizAnswer.code_language, QuizAnswer.client_version
+                                                     ).filter_by(submission_id=existing.id)}
+    return render_template('take_shared_quiz.html', quiz=quiz, questions=parsed_questions, saved_answers=saved_answers)
+
+def find_quiz_submission(code, student_id):
+    """
+    Load a shared quiz together with the student's submissions in a single query.
+    Returns (quiz, open_submission, already_completed); quiz is None for an unknown code.
+    """
+    rows = db.session.query(Quiz, QuizSubmission).outerjoin(
+        QuizSubmission, db.and_(QuizSubmission.quiz_id == Quiz.id, QuizSubmission.student_id == student_id)
+    ).filter(Quiz.code == code.upper()).all()
+    if not rows:
+        return None, None, False
+    submissions = [sub for _, sub in rows if sub is not None]
+    open_submission = next((sub for sub in submissions if not sub.completed), None)
+    return rows[0][0], open_submission, any(sub.completed for sub in submissions)
+
+QUIZ_ANSWER_DEFAULTS = {
+    'user_answer': '', 'code_language': None, 'is_correct': None, 'ai_score': None, 'scored_marks': 0.0,
+    'test_results_json': None, 'passed_test_cases': 0, 'total_test_cases': 0
+}
+
+def save_quiz_answers(submission_id, rows):
+    """
+    Upsert a submission's answer rows in one statement keyed on (submission_id, question_id),
+    so the cost doesn't grow with question count. Columns a row omits are reset to defaults.
+    """
+    if not rows:
+        return
+    rows = [{**QUIZ_ANSWER_DEFAULTS, **row} for row in rows]
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        stmt = (postgresql_insert if dialect == 'postgresql' else sqlite_insert)(QuizAnswer)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['submission_id', 'question_id'],
+            set_={column: stmt.excluded[column] for column in QUIZ_ANSWER_DEFAULTS}
+        )
+        db.session.execute(stmt, rows)
+        return
+    db.session.query(QuizAnswer).filter(
+        QuizAnswer.submission_id == submission_id,
+        QuizAnswer.question_id.in_([row['question_id'] for row in rows])
+    ).delete(synchronize_session=False)
+    db.session.execute(db.insert(QuizAnswer), rows)
+
+AUTOSAVE_MAX_ANSWER_CHARS = 100000
+
+def answer_language(question, language):
+    """
+    The language to store for an answer to a compiled payload question: the client's choice if
+    the question allows it, else its first allowed language (None for non-coding questions).
+    Client values never reach the 20-character code_language column unchecked.
+    """
+    allowed = question.get('language_constraints') or []
+    if language in allowed:
+        return language
+    return allowed[0] if allowed else None
+
+def autosave_quiz_answers(submission_id, rows):
+    """
+    Upsert autosaved answers without grading, one statement per batch. A row only replaces the
+    stored answer when its client_version is newer, so out-of-order requests can't roll it back.
+    """
+    if not rows:
+        return
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        stmt = (postgresql_insert if dialect == 'postgresql' else sqlite_insert)(QuizAnswer)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['submission_id', 'question_id'],
+            set_={column: stmt.excluded[column] for column in ('user_answer', 'code_language', 'client_version')},
+            where=db.func.coalesce(QuizAnswer.client_version, 0) < stmt.excluded.client_version
+        )
+        db.session.execute(stmt, rows)
+        return
+    current = {question_id: version or 0 for question_id, version in db.session.query(
+        QuizAnswer.question_id, QuizAnswer.client_version
+    ).filter(QuizAnswer.submission_id == submission_id, QuizAnswer.question_id.in_([row['question_id'] for row in rows]))}
+    rows = [row for row in rows if current.get(row['question_id'], -1) < row['client_version']]
+    for row in rows:
+        if row['question_id'] in current:
+            db.session.query(QuizAnswer).filter_by(submission_id=submission_id, question_id=row['question_id']).update(
+                {'user_answer': row['user_answer'], 'code_language': row['code_language'],
+                 'client_version': row['client_version']}, synchronize_session=False)
+        else:
+            db.session.execute(db.insert(QuizAnswer), [{**QUIZ_ANSWER_DEFAULTS, **row}])
+
+# Autosave changed answers while a shared quiz is open (graded only on final submit)
+@app.route('/quiz/autosave/<code>', methods=['POST'])
+@login_required
+def autosave_shared_quiz(code):
+    """
+    Body: {"answers": {"<question_id>": {"answer": "...", "language": "python", "version": 3}}}
+    carrying only the questions that changed since the last save.
+    """
+    data = request.get_json(silent=True) or {}
+    answers = data.get('answers')
+    if not isinstance(answers, dict):
+        return jsonify({'error': 'answers must be an object'}), 400
+    try:
+        quiz, submission, already_completed = find_quiz_submission(code, current_user.id)
+        if not quiz:
+            return jsonify({'error': 'Quiz not found'}), 404
+        if already_completed:
+            return jsonify({'error': 'Quiz already submitted'}), 409
+        payload_questions = {q['id']: q for q in get_quiz_payload(quiz)['questions']}
+        question_ids = set(payload_questions)
+        if not submission:
+            submission = QuizSubmission(quiz_id=quiz.id, student_id=current_user.id, question_count=len(question_ids))
+            db.session.add(submission)
+            db.session.flush()
+
+        rows = []
+        for question_id, delta in answers.items():
+            try:
+                question_id = int(question_id)
+                version = int(delta.get('version'))
+            except (AttributeError, TypeError, ValueError):
+                continue
+            if question_id not in question_ids:
+                continue
+            rows.append({
+                'submission_id': submission.id,
+                'question_id': question_id,
+                'user_answer': str(delta.get('answer') or '')[:AUTOSAVE_MAX_ANSWER_CHARS],
+                'code_language': answer_language(payload_questions[question_id], delta.get('language')),
+                'client_version': version
+            })
+        autosave_quiz_answers(submission.id, rows)
+        db.session.commit()
+        return jsonify({'status': 'ok', 'received': len(rows)})
+    except Exception as e:
+        db.session.rollback()
+        print(f"Autosave error: {e}")
+        return jsonify({'error': 'Autosave failed'}), 500
 
 # Submit shared quiz
 @app.route('/quiz/submit/<code>', methods=['POST'])
 @login_required
 def submit_shared_quiz(code):
-    quiz = db.session.query(Quiz).filter_by(code=code.upper()).first()
+    quiz, submission, already_completed = find_quiz_submission(code, current_user.id)
     if not quiz:
         flash('Quiz not found', 'error')
         return redirect(url_for('join_quiz'))
     
     # Check if student has already completed this quiz
-    existing_completed = db.session.query(QuizSubmission).filter_by(
-        quiz_id=quiz.id, 
-        student_id=current_user.id, 
-        completed=True
-    ).first()
-    
-    if existing_completed:
+    if already_completed:
         flash('You have already attempted this quiz. You can only take it once.', 'error')
         return redirect(url_for('dashboard'))
-    questions = db.session.query(QuizQuestion).filter_by(quiz_id=quiz.id).all()
+    questions = get_quiz_payload(quiz)['questions']
 
-    total_marks = 0.0
-    scored_marks = 0.0
     from datetime import timedelta
-    submission = db.session.query(QuizSubmission).filter_by(quiz_id=quiz.id, student_id=current_user.id, completed=False).first()
     if not submission:
         submission = QuizSubmission(quiz_id=quiz.id, student_id=current_user.id)
         db.session.add(submission)
         db.session.flush()
 
+    # Store answers now; scoring (test-case runs, AI evaluation) happens in the grading queue
+    total_marks = 0.0
     answered_count = 0
+    answer_rows = []
     for q in questions:
-        total_marks += float(q.marks or 1)
-        key = f'q_{q.id}'
-        user_ans = request.form.get(key, '').strip()
-        is_correct = None
-        ai_score = None
-        gained = 0.0
+        total_marks += float(q['marks'] or 1)
+        user_ans = request.form.get(f"q_{q['id']}", '').strip()
         code_language = None
-        test_results_json = None
-        passed_test_cases = 0
-        total_test_cases = 0
 
-        if q.qtype == 'mcq':
-            is_correct = (user_ans.split('. ')[0] == (q.answer or '')) if user_ans else False
-            gained = float(q.marks or 1) if is_correct else 0.0
-        elif q.qtype == 'coding':
-            # Handle coding question submission
-            code_data = request.form.get(f'code_{q.id}', '').strip()
-            language = request.form.get(f'language_{q.id}', 'python')
-            
+        if q['qtype'] == 'coding':
+            code_data = request.form.get(f"code_{q['id']}", '').strip()
             if code_data:
-                try:
-                    # Parse test cases
-                    test_cases = json.loads(q.test_cases_json) if q.test_cases_json else []
-                    time_limit = q.time_limit_seconds or 2
-                    memory_limit = q.memory_limit_mb or 256
-                    
-                    # Run test cases
-                    test_results = run_test_cases(code_data, language, test_cases, time_limit, memory_limit)
-                    
-                    # Calculate score based on passed test cases
-                    passed_test_cases = test_results['passed']
-                    total_test_cases = test_results['total']
-                    percentage_passed = test_results['percentage'] / 100.0
-                    
-                    gained = float(q.marks or 1) * percentage_passed
-                    is_correct = percentage_passed == 1.0  # Perfect score
-                    code_language = language
-                    test_results_json = json.dumps(test_results['results'])
-                    user_ans = code_data  # Store code as answer
-                except Exception as e:
-                    print(f"Error evaluating coding question: {e}")
-                    gained = 0.0
-                    is_correct = False
-                    code_language = language
-                    test_results_json = json.dumps([])
-                    user_ans = code_data
-        else:
-            # subjective via AI
-            if user_ans:
-                ai_score = evaluate_subjective_answer(q.question, user_ans, q.answer or '')
-                gained = float(q.marks or 1) * float(ai_score or 0.0)
-                is_correct = (ai_score or 0.0) >= 0.6
-            else:
-                ai_score = 0.0
-                is_correct = False
-
-        scored_marks += gained
-        ans = QuizAnswer(
-            submission_id=submission.id,
-            question_id=q.id,
-            user_answer=user_ans,
-            is_correct=is_correct,
-            ai_score=ai_score,
-            scored_marks=gained,
-            code_language=code_language,
-            test_results_json=test_results_json,
-            passed_test_cases=passed_test_cases,
-            total_test_cases=total_test_cases
-        )
-        db.session.add(ans)
+                user_ans = code_data  # Store code as answer
+                code_language = answer_language(q, request.form.get(f"language_{q['id']}"))
+
+        answer_rows.append({
+            'submission_id': submission.id,
+            'question_id': q['id'],
+            'user_answer': user_ans,
+            'code_language': code_language,
+            'is_correct': None,
+            'ai_score': None,
+            'scored_marks': 0.0
+        })
         if user_ans:
             answered_count += 1
+    save_quiz_answers(submission.id, answer_rows)
 
-    percentage = (scored_marks / total_marks) * 100 if total_marks > 0 else 0
-    passed = percentage >= 60
-    submission.score = scored_marks
+    submission.score = 0.0
     submission.total = total_marks
-    submission.percentage = percentage
-    submission.passed = passed
+    submission.percentage = 0.0
+    submission.passed = False
     # set review unlock time 15 minutes after submission
     submission.review_unlocked_at = datetime.utcnow() + timedelta(minutes=15)
     # check if student exited fullscreen during test
@@ -1652,72 +4296,76 @@ def submit_shared_quiz(code):
     submission.question_count = len(questions)
     submission.is_full_completion = (answered_count == len(questions)) and (not submission.fullscreen_exit_flag)
     submission.completed = True
+    job = enqueue_grading(submission)
     db.session.commit()
 
-    flash(f'Submitted. Score: {scored_marks:.1f}/{total_marks} ({percentage:.0f}%).', 'success')
+    dispatch_grading(job)
+    flash('Submitted. Your answers are being graded; your score will appear on the dashboard shortly.', 'success')
     return redirect(url_for('dashboard'))
 
+# Drain the grading queue (cron hook for deployments without background workers).
+# Vercel Cron calls it with GET and "Authorization: Bearer $CRON_SECRET"; other
+# schedulers can POST with an X-Task-Token header matching GRADING_TASK_TOKEN.
+@app.route('/tasks/grading/run', methods=['GET', 'POST'])
+def run_grading_tasks():
+    task_token = os.environ.get('GRADING_TASK_TOKEN')
+    cron_secret = os.environ.get('CRON_SECRET')
+    authorized = (task_token and secrets.compare_digest(request.headers.get('X-Task-Token', ''), task_token)) or (
+        cron_secret and secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {cron_secret}'))
+    if not authorized:
+        return jsonify({'error': 'Not found'}), 404
+    # Bounded by time, not count: one AI-graded submission can take many seconds, and a function
+    # killed mid-job leaves it 'running' until GRADING_JOB_TIMEOUT requeues it
+    deadline = time.monotonic() + GRADING_TASK_BUDGET_SECONDS
+    processed = 0
+    while time.monotonic() < deadline and process_grading_job():
+        processed += 1
+    return jsonify({'status': 'ok', 'processed': processed})
+
 # Auto-submit partial answers on fullscreen exit or tab close
 @app.route('/quiz/auto_submit/<code>', methods=['POST'])
 @login_required
 def auto_submit_partial(code):
+    # Nobody reads this beacon's response: store the answers and leave scoring to the grading queue
     try:
-        quiz = db.session.query(Quiz).filter_by(code=code.upper()).first()
-        if not quiz:
+        quiz, submission, already_completed = find_quiz_submission(code, current_user.id)
+        if not quiz or already_completed:
             return ('', 204)
-        questions = db.session.query(QuizQuestion).filter_by(quiz_id=quiz.id).all()
-        submission = db.session.query(QuizSubmission).filter_by(quiz_id=quiz.id, student_id=current_user.id, completed=False).first()
+        questions = get_quiz_payload(quiz)['questions']
         if not submission:
             submission = QuizSubmission(quiz_id=quiz.id, student_id=current_user.id)
             db.session.add(submission)
             db.session.flush()
 
+        data = request.get_json(silent=True) or {}
+        # Answers the beacon missed keep their autosaved value
+        saved = {row.question_id: row for row in db.session.query(
+            QuizAnswer.question_id, QuizAnswer.user_answer, QuizAnswer.code_language
+        ).filter_by(submission_id=submission.id)}
         total_marks = 0.0
-        scored_marks = 0.0
         answered_count = 0
-        data = request.get_json(silent=True) or {}
-
+        answer_rows = []
         for q in questions:
-            total_marks += float(q.marks or 1)
-            key = f'q_{q.id}'
-            user_ans = (data.get(key) or '').strip()
-            is_correct = None
-            ai_score = None
-            gained = 0.0
-            if q.qtype == 'mcq':
-                is_correct = (user_ans.split('. ')[0] == (q.answer or '')) if user_ans else False
-                gained = float(q.marks or 1) if is_correct else 0.0
-            else:
-                if user_ans:
-                    ai_score = evaluate_subjective_answer(q.question, user_ans, q.answer or '')
-                    gained = float(q.marks or 1) * float(ai_score or 0.0)
-                    is_correct = (ai_score or 0.0) >= 0.6
-                else:
-                    ai_score = 0.0
-                    is_correct = False
+            total_marks += float(q['marks'] or 1)
+            user_ans = (data.get(f"q_{q['id']}") or '').strip()
+            code_language = answer_language(q, data.get(f"language_{q['id']}"))
+            if not user_ans and q['id'] in saved:
+                user_ans = (saved[q['id']].user_answer or '').strip()
+                code_language = saved[q['id']].code_language
             if user_ans:
                 answered_count += 1
-            # Upsert answer
-            existing_ans = db.session.query(QuizAnswer).filter_by(submission_id=submission.id, question_id=q.id).first()
-            if existing_ans:
-                existing_ans.user_answer = user_ans
-                existing_ans.is_correct = is_correct
-                existing_ans.ai_score = ai_score
-                existing_ans.scored_marks = gained
-            else:
-                db.session.add(QuizAnswer(
-                    submission_id=submission.id,
-                    question_id=q.id,
-                    user_answer=user_ans,
-                    is_correct=is_correct,
-                    ai_score=ai_score,
-                    scored_marks=gained
-                ))
-
-        submission.score = scored_marks
+            answer_rows.append({
+                'submission_id': submission.id,
+                'question_id': q['id'],
+                'user_answer': user_ans,
+                'code_language': code_language if user_ans else None
+            })
+        save_quiz_answers(submission.id, answer_rows)
+
+        submission.score = 0.0
         submission.total = total_marks
-        submission.percentage = (scored_marks / total_marks) * 100 if total_marks > 0 else 0
-        submission.passed = submission.percentage >= 60
+        submission.percentage = 0.0
+        submission.passed = False
         from datetime import timedelta
         submission.review_unlocked_at = datetime.utcnow() + timedelta(minutes=15)
         submission.fullscreen_exit_flag = True
@@ -1725,10 +4373,13 @@ def auto_submit_partial(code):
         submission.question_count = len(questions)
         submission.is_full_completion = False
         submission.completed = True
+        job = enqueue_grading(submission)
         db.session.commit()
+        dispatch_grading(job)
         return ('', 204)
     except Exception as e:
         db.session.rollback()
+        print(f"Auto-submit error: {e}")
         return ('', 204)
 
 # Student: view quiz result (after 15 minutes)
@@ -1746,6 +4397,12 @@ def view_quiz_result(submission_id):
     if submission.review_unlocked_at and submission.review_unlocked_at > current_time:
         flash('Results will be available 15 minutes after submission', 'info')
         return redirect(url_for('dashboard'))
+    if submission.grading_status == 'pending':
+        flash('Your answers are still being graded. Please check back shortly.', 'info')
+        return redirect(url_for('dashboard'))
+    if submission.grading_status == 'failed':
+        flash('Grading your answers failed. Your teacher can regrade the submission.', 'error')
+        return redirect(url_for('dashboard'))
     
     # Get quiz and questions
     quiz = db.session.query(Quiz).filter_by(id=submission.quiz_id).first()
@@ -1830,7 +4487,41 @@ def teacher_quiz_results(code):
     submissions = db.session.query(QuizSubmission).filter_by(quiz_id=quiz.id).order_by(QuizSubmission.submitted_at.desc()).all()
     # Join with users
     student_map = {u.id: u for u in db.session.query(User).filter(User.id.in_([s.student_id for s in submissions])).all()}
-    return render_template('teacher_results.html', quiz=quiz, submissions=submissions, student_map=student_map)
+    stale = count_stale_grading_jobs(quiz.id)
+    if stale:
+        print(f"{stale} grading jobs for quiz {quiz.code} queued over {GRADING_STALE_SECONDS}s", file=sys.stderr)
+        flash(f'{stale} submission(s) have been waiting over {GRADING_STALE_SECONDS // 60} minutes for grading. '
+              'The grading queue is not being processed: check GRADING_WORKERS or the /tasks/grading/run cron.', 'error')
+    exam = db.session.get(ExamSession, quiz.id)
+    return render_template('teacher_results.html', quiz=quiz, submissions=submissions, student_map=student_map,
+                           exam=exam if exam and exam.active else None)
+
+# Teacher: queue a submission for grading again (e.g. after grading failed)
+@app.route('/teacher/quiz/<code>/regrade/<int:submission_id>', methods=['POST'])
+@login_required
+def regrade_submission(code, submission_id):
+    guard = require_teacher()
+    if guard:
+        return guard
+    
+    quiz = db.session.query(Quiz).filter_by(code=code.upper(), created_by=current_user.id).first()
+    if not quiz:
+        flash('Quiz not found or you do not have permission', 'error')
+        return redirect(url_for('dashboard'))
+    
+    submission = db.session.query(QuizSubmission).filter_by(id=submission_id, quiz_id=quiz.id, completed=True).first()
+    if not submission:
+        flash('Submission not found', 'error')
+        return redirect(url_for('teacher_quiz_results', code=code))
+    if submission.grading_status == 'pending':
+        flash('This submission is already queued for grading.', 'info')
+        return redirect(url_for('teacher_quiz_results', code=code))
+    
+    job = enqueue_grading(submission)
+    db.session.commit()
+    dispatch_grading(job)
+    flash('Submission queued for grading.', 'success')
+    return redirect(url_for('teacher_quiz_results', code=code))
 
 # Teacher: allow student to retake quiz
 @app.route('/teacher/quiz/<code>/allow-retake/<int:submission_id>', methods=['POST'])
@@ -1870,6 +4561,8 @@ def allow_student_retake(code, submission_id):
     submission.answered_count = 0
     submission.fullscreen_exit_flag = False
     submission.is_full_completion = False
+    submission.grading_status = 'graded'
+    db.session.query(GradingJob).filter_by(submission_id=submission.id).delete()
     
     db.session.commit()
     
@@ -1933,6 +4626,8 @@ def dev_migrate():
                     conn.execute(text("ALTER TABLE quiz_submission ADD COLUMN started_at DATETIME;"))
                 if 'completed' not in cols:
                     conn.execute(text("ALTER TABLE quiz_submission ADD COLUMN completed BOOLEAN DEFAULT 0;"))
+                if 'grading_status' not in cols:
+                    conn.execute(text("ALTER TABLE quiz_submission ADD COLUMN grading_status VARCHAR(20) DEFAULT 'graded';"))
             except Exception as e:
                 print(f"ALTER TABLE quiz_submission add columns failed (may exist): {e}")
 
@@ -1974,6 +4669,7 @@ def dev_migrate():
 
         # Create any new tables
         db.create_all()
+        run_schema_migrations()
         flash('Migration completed. If you were logged in, reload the page. Next, visit /dev/promote_me.', 'success')
     except Exception as e:
         print(f"Migration error: {e}")
@@ -2058,21 +4754,23 @@ def quiz():
         # Generate questions using difficulty level
         questions = []
         if question_type == "both":
-            mcq_questions = generate_quiz(topic, difficulty_level, "mcq", mcq_count)
-            subj_questions = generate_quiz(topic, difficulty_level, "subjective", subj_count)
+            mcq_questions, subj_questions = run_concurrently([
+                (get_quiz_questions, (topic, difficulty_level, "mcq", mcq_count)),
+                (get_quiz_questions, (topic, difficulty_level, "subjective", subj_count)),
+            ])
             if mcq_questions and subj_questions:
                 questions = mcq_questions + subj_questions
         else:
             num_q = mcq_count if question_type == "mcq" else subj_count
-            questions = generate_quiz(topic, difficulty_level, question_type, num_q)
+            questions = get_quiz_questions(topic, difficulty_level, question_type, num_q)
 
         if questions:
-            session['current_quiz'] = {
+            save_quiz_attempt('current_quiz', {
                 'questions': questions,
                 'topic': topic,
                 'bloom_level': bloom_level,
                 'difficulty_level': difficulty_level
-            }
+            })
             return redirect(url_for('take_quiz'))
         else:
             flash('Failed to generate quiz questions', 'error')
@@ -2082,7 +4780,7 @@ def quiz():
 @app.route('/take_quiz')
 @login_required
 def take_quiz():
-    quiz_data = session.get('current_quiz')
+    quiz_data = load_quiz_attempt('current_quiz')
     if not quiz_data:
         flash('No quiz available', 'error')
         return redirect(url_for('quiz'))
@@ -2092,7 +4790,7 @@ def take_quiz():
 @app.route('/submit_quiz', methods=['POST'])
 @login_required
 def submit_quiz():
-    quiz_data = session.get('current_quiz')
+    quiz_data = load_quiz_attempt('current_quiz')
     if not quiz_data:
         return jsonify({'error': 'No quiz available'})
 
@@ -2122,6 +4820,12 @@ def submit_quiz():
     scored_marks = 0
     results = []
 
+    subjective_idx = [i for i, q in enumerate(questions) if q.get('type') != 'mcq']
+    ai_scores = evaluate_subjective_answers(
+        [(questions[i]['question'], user_answers[i], questions[i].get('answer', '')) for i in subjective_idx]
+    )
+    ai_score_map = dict(zip(subjective_idx, ai_scores))
+
     for i, (q, user_ans) in enumerate(zip(questions, user_answers)):
         if q.get('type') == 'mcq':
             user_choice = user_ans.split(". ")[0] if user_ans else ""
@@ -2140,7 +4844,7 @@ def submit_quiz():
             total_marks += marks
             
             if user_ans.strip():
-                ai_score = evaluate_subjective_answer(q['question'], user_ans, q.get('answer', ''))
+                ai_score = ai_score_map.get(i, 0.0)
                 scored_marks += ai_score * marks
                 if ai_score >= 0.6:
                     correct_answers += 1
@@ -2169,23 +4873,21 @@ def submit_quiz():
         passed = percentage >= 60
         final_score = f"{correct_answers}/{len(questions)}"
 
-    # Update progress
-    progress = db.session.query(Progress).filter_by(user_id=current_user.id, topic=topic).first()
-    if progress:
-        if passed and bloom_level + 1 > progress.bloom_level:
-            progress.bloom_level = bloom_level + 1
-    else:
-        new_progress = Progress(
-            user_id=current_user.id,
-            topic=topic,
-            bloom_level=bloom_level + 1 if passed else bloom_level
-        )
-        db.session.add(new_progress)
+    # Update progress: insert-if-missing then raise the level, so two submits for the same topic
+    # can't both insert and trip the unique (user_id, topic) index
+    new_level = bloom_level + 1 if passed else bloom_level
+    db.session.execute(insert_ignore_duplicates(Progress), [
+        {'user_id': current_user.id, 'topic': topic, 'bloom_level': new_level, 'created_at': datetime.utcnow()}
+    ])
+    if passed:
+        db.session.query(Progress).filter(
+            Progress.user_id == current_user.id, Progress.topic == topic, Progress.bloom_level < new_level
+        ).update({'bloom_level': new_level}, synchronize_session=False)
     
     db.session.commit()
 
     # Clear quiz session
-    session.pop('current_quiz', None)
+    discard_quiz_attempt('current_quiz')
 
     return render_template('quiz_results.html', 
                          results=results, 
@@ -2217,15 +4919,15 @@ def next_level():
         next_difficulty = difficulty_mapping.get(difficulty_level, "intermediate")
         
         # Generate questions for next level
-        questions = generate_quiz(topic, next_difficulty, "mcq", 5)
+        questions = get_quiz_questions(topic, next_difficulty, "mcq", 5)
         
         if questions:
-            session['current_quiz'] = {
+            save_quiz_attempt('current_quiz', {
                 'questions': questions,
                 'topic': topic,
                 'bloom_level': 1,  # This will be updated based on difficulty
                 'difficulty_level': next_difficulty
-            }
+            })
             flash(f'Generated {next_difficulty.title()} level quiz for {topic}!', 'success')
             return redirect(url_for('take_quiz'))
         else:
@@ -2249,15 +4951,15 @@ def retry_level():
             return redirect(url_for('quiz'))
         
         # Generate questions for the same level
-        questions = generate_quiz(topic, difficulty_level, "mcq", 5)
+        questions = get_quiz_questions(topic, difficulty_level, "mcq", 5)
         
         if questions:
-            session['current_quiz'] = {
+            save_quiz_attempt('current_quiz', {
                 'questions': questions,
                 'topic': topic,
                 'bloom_level': 1,  # This will be updated based on difficulty
                 'difficulty_level': difficulty_level
-            }
+            })
             flash(f'Generated new {difficulty_level.title()} level quiz for {topic}!', 'success')
             return redirect(url_for('take_quiz'))
         else:
@@ -2290,15 +4992,15 @@ def continue_learning():
         difficulty_level = get_difficulty_from_bloom_level(progress.bloom_level)
         
         # Generate questions for the current level
-        questions = generate_quiz(topic, difficulty_level, "mcq", 5)
+        questions = get_quiz_questions(topic, difficulty_level, "mcq", 5)
         
         if questions:
-            session['current_quiz'] = {
+            save_quiz_attempt('current_quiz', {
                 'questions': questions,
                 'topic': topic,
                 'bloom_level': progress.bloom_level,
                 'difficulty_level': difficulty_level
-            }
+            })
             flash(f'Continuing {topic} at {difficulty_level.title()} level (Bloom Level {progress.bloom_level})!', 'success')
             return redirect(url_for('take_quiz'))
         else:
@@ -2346,23 +5048,19 @@ def upload_pdf():
     
     return jsonify({'success': False, 'error': 'Invalid file format. Please upload a PDF.'})
 
-@app.route('/ai_learn', methods=['POST'])
-@login_required
-def ai_learn():
-    """AI-powered learning content generation"""
-    try:
-        data = request.get_json()
-        topic = data.get('topic', '').strip()
-        level = data.get('level', 'intermediate')
-        style = data.get('style', 'theoretical')
-        
-        if not topic:
-            return jsonify({'success': False, 'error': 'Topic is required'})
-        
-        # Generate learning content using AI
-        configure_google_ai()  # Ensure Google AI is configured
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        prompt = f"""
+# Learning paths are shared across students: cached per normalized (topic, level, style), and
+# concurrent requests for the same key wait on a single Gemini call
+AI_LEARN_CACHE_TTL = int(os.environ.get('AI_LEARN_CACHE_TTL', str(24 * 3600)))
+AI_LEARN_CACHE_SIZE = int(os.environ.get('AI_LEARN_CACHE_SIZE', '512'))
+learning_content_cache = TTLCache(maxsize=AI_LEARN_CACHE_SIZE, ttl=AI_LEARN_CACHE_TTL)
+
+def learning_content_key(topic, level, style):
+    return (normalize_answer_text(topic), normalize_answer_text(level), normalize_answer_text(style), GEMINI_MODEL)
+
+@single_flight(key=learning_content_key)
+def generate_learning_content(topic, level, style):
+    """Ask Gemini for a learning path in the fixed section format the learn page renders"""
+    prompt = f"""
         Create a personalized learning path for {topic} at {level} level, 
         focusing on {style} learning style.
         
@@ -2393,9 +5091,34 @@ def ai_learn():
         
         CRITICAL: Start your response immediately with "## OVERVIEW" and follow the exact format above. Do not add any introductory text or explanations before the sections.
         """
+
+    response = ai_generate('ai_learn', prompt)
+    return response.text.strip()
+
+def get_learning_content(topic, level, style):
+    key = learning_content_key(topic, level, style)
+    content = learning_content_cache.get(key)
+    if content is None:
+        content = generate_learning_content(topic, level, style)
+        if content:
+            learning_content_cache.set(key, content)
+    return content
+
+@app.route('/ai_learn', methods=['POST'])
+@login_required
+def ai_learn():
+    """AI-powered learning content generation"""
+    try:
+        data = request.get_json()
+        topic = data.get('topic', '').strip()
+        level = data.get('level', 'intermediate')
+        style = data.get('style', 'theoretical')
+        
+        if not topic:
+            return jsonify({'success': False, 'error': 'Topic is required'})
         
-        response = model.generate_content(prompt)
-        content = response.text.strip()
+        # Generate learning content using AI (cached and coalesced per topic/level/style)
+        content = get_learning_content(topic, level, style)
         
         return jsonify({'success': True, 'content': content})
         
@@ -2409,6 +5132,11 @@ def download_pdf():
     return jsonify({'error': 'PDF download not available on Vercel'}), 503
 
 # Download quiz results as CSV
+CSV_EXPORT_BATCH_SIZE = 1000
+GRADING_STATUS_LABELS = {'pending': 'Grading', 'failed': 'Grading failed'}
+QUIZ_RESULTS_CSV_COLUMNS = ['Student', 'Score', 'Percentage', 'Status', 'Integrity', 'Answered Questions',
+                            'Exited Fullscreen', 'Submitted At']
+
 @app.route('/teacher/quiz/<code>/results/download/csv')
 @login_required
 def download_quiz_results_csv(code):
@@ -2421,50 +5149,42 @@ def download_quiz_results_csv(code):
         flash('Quiz not found', 'error')
         return redirect(url_for('dashboard'))
     
-    submissions = db.session.query(QuizSubmission).filter_by(quiz_id=quiz.id).order_by(QuizSubmission.submitted_at.desc()).all()
-    student_map = {u.id: u for u in db.session.query(User).filter(User.id.in_([s.student_id for s in submissions])).all()}
-    
-    # Prepare data for CSV
-    data = []
-    for s in submissions:
-        student = student_map.get(s.student_id)
-        data.append({
-            'Student': student.username if student else str(s.student_id),
-            'Score': f"{s.score:.1f}/{s.total:.1f}",
-            'Percentage': f"{s.percentage:.0f}%",
-            'Status': 'Passed' if s.passed else 'Failed',
-            'Integrity': 'Clean' if s.is_full_completion else 'Hold',
-            'Answered Questions': f"{s.answered_count}/{s.question_count}",
-            'Exited Fullscreen': 'Yes' if s.fullscreen_exit_flag else 'No',
-            'Submitted At': s.submitted_at.strftime('%Y-%m-%d %H:%M:%S')
-        })
-    
-    # Create CSV (use pandas if available, otherwise use csv module)
-    if HAS_PANDAS:
-        df = pd.DataFrame(data)
-        csv_buffer = io.StringIO()
-        df.to_csv(csv_buffer, index=False)
-        csv_data = csv_buffer.getvalue()
-    else:
-        # Use built-in csv module
-        csv_buffer = io.StringIO()
-        if data:
-            writer = csv.DictWriter(csv_buffer, fieldnames=data[0].keys())
-            writer.writeheader()
-            writer.writerows(data)
-        csv_data = csv_buffer.getvalue()
-    
-    # Create BytesIO for send_file
-    output = io.BytesIO()
-    output.write(csv_data.encode('utf-8'))
-    output.seek(0)
-    
-    return send_file(
-        output,
-        as_attachment=True,
-        download_name=f"Quiz_Results_{quiz.title}_{code}.csv",
-        mimetype='text/csv'
-    )
+    # Stream rows straight from the cursor so memory stays flat however many submissions there are
+    rows = db.session.query(
+        User.username, QuizSubmission.student_id, QuizSubmission.score, QuizSubmission.total,
+        QuizSubmission.percentage, QuizSubmission.grading_status, QuizSubmission.passed,
+        QuizSubmission.is_full_completion, QuizSubmission.answered_count, QuizSubmission.question_count,
+        QuizSubmission.fullscreen_exit_flag, QuizSubmission.submitted_at
+    ).outerjoin(User, User.id == QuizSubmission.student_id).filter(
+        QuizSubmission.quiz_id == quiz.id
+    ).order_by(QuizSubmission.submitted_at.desc()).execution_options(yield_per=CSV_EXPORT_BATCH_SIZE)
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(QUIZ_RESULTS_CSV_COLUMNS)
+        for n, s in enumerate(rows, start=1):
+            writer.writerow([
+                s.username or str(s.student_id),
+                f"{s.score:.1f}/{s.total:.1f}",
+                f"{s.percentage:.0f}%",
+                GRADING_STATUS_LABELS.get(s.grading_status) or ('Passed' if s.passed else 'Failed'),
+                'Clean' if s.is_full_completion else 'Hold',
+                f"{s.answered_count}/{s.question_count}",
+                'Yes' if s.fullscreen_exit_flag else 'No',
+                s.submitted_at.strftime('%Y-%m-%d %H:%M:%S')
+            ])
+            if n % CSV_EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    download_name = f"Quiz_Results_{quiz.title}_{code}.csv"
+    ascii_name = download_name.encode('ascii', 'ignore').decode().replace('"', '') or 'Quiz_Results.csv'
+    return Response(stream_with_context(generate()), mimetype='text/csv', headers={
+        'Content-Disposition': f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(download_name)}"
+    })
 
 # Download quiz results as XLSX
 @app.route('/teacher/quiz/<code>/results/download/xlsx')
@@ -2490,7 +5210,7 @@ def download_quiz_results_xlsx(code):
             'Student': student.username if student else str(s.student_id),
             'Score': f"{s.score:.1f}/{s.total:.1f}",
             'Percentage': f"{s.percentage:.0f}%",
-            'Status': 'Passed' if s.passed else 'Failed',
+            'Status': GRADING_STATUS_LABELS.get(s.grading_status) or ('Passed' if s.passed else 'Failed'),
             'Integrity': 'Clean' if s.is_full_completion else 'Hold',
             'Answered Questions': f"{s.answered_count}/{s.question_count}",
             'Exited Fullscreen': 'Yes' if s.fullscreen_exit_flag else 'No',
@@ -2532,6 +5252,7 @@ def init_database():
     try:
         with app.app_context():
             db.create_all()
+            run_schema_migrations()
             print("Database initialized successfully!")
             print(f"Using database: {app.config['SQLALCHEMY_DATABASE_URI']}")
     except Exception as e:
@@ -2542,6 +5263,8 @@ def init_database():
 # Initialize database only if not in Vercel environment
 if not os.environ.get('VERCEL'):
     init_database()
+    # Pick up any submissions queued before a restart
+    start_grading_workers()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
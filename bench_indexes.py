@@ -0,0 +1,152 @@
+"""
+Benchmark the hot quiz queries with and without the schema migration 1 indexes.
+
+Builds a throwaway database with 100k quiz submissions (plus their answers, questions and
+progress rows), times each query pattern used on the quiz pages without the indexes, then
+applies the migration and times them again.
+
+Usage: python bench_indexes.py [--submissions 100000] [--database-url sqlite:////tmp/bench.db]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--submissions', type=int, default=100000)
+    parser.add_argument('--answers-per-submission', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=200, help='timed runs per query')
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file (never your DATABASE_URL)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    db_file = None
+    if not args.database_url:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+        args.database_url = f'sqlite:///{db_file}'
+    # Point the app at the benchmark database before importing it
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ['VERCEL'] = '1'  # skip init_database() and grading workers on import
+    os.environ.setdefault('GRADING_WORKERS', '0')
+
+    from sqlalchemy import text
+    from app import (app, db, Progress, Quiz, QuizQuestion, QuizSubmission, QuizAnswer, SchemaVersion,
+                     SCHEMA_MIGRATIONS, run_schema_migrations)
+
+    migrated_models = (Progress, Quiz, QuizQuestion, QuizSubmission, QuizAnswer)
+    rng = random.Random(42)
+    n_students = max(1, args.submissions // 20)
+    n_teachers = max(1, n_students // 25)
+    n_quizzes = max(1, args.submissions // 50)
+    questions_per_quiz = max(1, args.answers_per_submission)
+
+    with app.app_context():
+        # drop_all() below wipes the database, so refuse to run anywhere but the requested one
+        engine_url = db.engine.url.render_as_string(hide_password=False)
+        if engine_url != args.database_url:
+            sys.exit(f"Refusing to run: the app opened {engine_url}, not {args.database_url} "
+                     "(use an absolute sqlite:////path or a postgresql:// URL)")
+        db.drop_all()
+        db.create_all()
+        # Start from the pre-migration schema
+        for model in migrated_models:
+            for index in model.__table__.indexes:
+                index.drop(bind=db.engine, checkfirst=True)
+
+        print(f"Populating {args.database_url} ...")
+        started = time.perf_counter()
+        user_rows = [{'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': 'x',
+                      'role': 'teacher' if i <= n_teachers else 'student'}
+                     for i in range(1, n_teachers + n_students + 1)]
+        db.session.execute(db.insert(db.metadata.tables['user']), user_rows)
+        quiz_rows = [{'id': i, 'title': f'Quiz {i}', 'code': f'Q{i:07d}', 'created_by': rng.randint(1, n_teachers)}
+                     for i in range(1, n_quizzes + 1)]
+        db.session.execute(db.insert(Quiz), quiz_rows)
+        question_rows = [{'id': (quiz_id - 1) * questions_per_quiz + n + 1, 'quiz_id': quiz_id,
+                          'question': f'Question {n}', 'answer': 'A', 'qtype': 'mcq', 'marks': 1}
+                         for quiz_id in range(1, n_quizzes + 1) for n in range(questions_per_quiz)]
+        db.session.execute(db.insert(QuizQuestion), question_rows)
+
+        student_ids = range(n_teachers + 1, n_teachers + n_students + 1)
+        batch = []
+        answer_batch = []
+        for sub_id in range(1, args.submissions + 1):
+            quiz_id = rng.randint(1, n_quizzes)
+            batch.append({'id': sub_id, 'quiz_id': quiz_id, 'student_id': rng.choice(student_ids),
+                          'completed': rng.random() < 0.9, 'score': 1.0, 'total': float(questions_per_quiz)})
+            first_question = (quiz_id - 1) * questions_per_quiz + 1
+            answer_batch.extend({'submission_id': sub_id, 'question_id': first_question + n, 'user_answer': 'A'}
+                                for n in range(questions_per_quiz))
+            if len(batch) >= 5000:
+                db.session.execute(db.insert(QuizSubmission), batch)
+                db.session.execute(db.insert(QuizAnswer), answer_batch)
+                batch, answer_batch = [], []
+        if batch:
+            db.session.execute(db.insert(QuizSubmission), batch)
+            db.session.execute(db.insert(QuizAnswer), answer_batch)
+
+        progress_rows = [{'user_id': student, 'topic': f'topic{t}', 'bloom_level': 1}
+                         for student in student_ids for t in range(5)]
+        db.session.execute(db.insert(Progress), progress_rows)
+        db.session.commit()
+        print(f"  {args.submissions} submissions, {args.submissions * questions_per_quiz} answers, "
+              f"{n_quizzes} quizzes, {len(progress_rows)} progress rows in {time.perf_counter() - started:.1f}s")
+
+        queries = {
+            'QuizSubmission(quiz_id, student_id, completed)': lambda: db.session.query(QuizSubmission).filter_by(
+                quiz_id=rng.randint(1, n_quizzes), student_id=rng.choice(student_ids), completed=True).first(),
+            'QuizSubmission(student_id)': lambda: db.session.query(QuizSubmission).filter_by(
+                student_id=rng.choice(student_ids)).all(),
+            'QuizQuestion(quiz_id)': lambda: db.session.query(QuizQuestion).filter_by(
+                quiz_id=rng.randint(1, n_quizzes)).order_by(QuizQuestion.id).all(),
+            'QuizAnswer(submission_id)': lambda: db.session.query(QuizAnswer).filter_by(
+                submission_id=rng.randint(1, args.submissions)).all(),
+            'Progress(user_id, topic)': lambda: db.session.query(Progress).filter_by(
+                user_id=rng.choice(student_ids), topic=f'topic{rng.randint(0, 4)}').first(),
+            'Quiz(created_by)': lambda: db.session.query(Quiz).filter_by(
+                created_by=rng.randint(1, n_teachers)).all(),
+        }
+
+        def measure():
+            results = {}
+            for name, run in queries.items():
+                run()  # warm up
+                timings = []
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    run()
+                    timings.append((time.perf_counter() - started) * 1000)
+                    db.session.rollback()
+                results[name] = statistics.median(timings)
+            return results
+
+        before = measure()
+        db.session.query(SchemaVersion).delete()
+        db.session.commit()
+        started = time.perf_counter()
+        run_schema_migrations()
+        migration_seconds = time.perf_counter() - started
+        after = measure()
+
+        print(f"\nSchema migrations {[version for version, _, _ in SCHEMA_MIGRATIONS]} applied in {migration_seconds:.1f}s")
+        print(f"\n{'query (median of %d runs)' % args.repeat:<50} {'before ms':>10} {'after ms':>10} {'speedup':>9}")
+        for name in queries:
+            speedup = before[name] / after[name] if after[name] else float('inf')
+            print(f"{name:<50} {before[name]:>10.3f} {after[name]:>10.3f} {speedup:>8.1f}x")
+
+        db.session.remove()
+        db.engine.dispose()
+    if db_file:
+        os.unlink(db_file)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
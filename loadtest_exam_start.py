@@ -0,0 +1,156 @@
+"""
+Load-test an exam start: N students join the same quiz code at the same moment.
+
+Runs two rounds against a throwaway database, each on its own quiz:
+  direct - every student joins and opens the quiz page at once (no exam mode)
+  exam   - the teacher starts exam mode first (payload warmed), students join, wait in the
+           lobby polling its status, then open the quiz page
+and reports p50/p95/p99 latency per page plus errors. Students are simulated with Flask test
+clients on threads released together by a barrier.
+
+Usage: python loadtest_exam_start.py [--students 500] [--admit-per-minute 3000]
+                                     [--database-url postgresql://.../loadtest]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--students', type=int, default=500)
+    parser.add_argument('--questions', type=int, default=20)
+    parser.add_argument('--admit-per-minute', type=int, default=3000)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file (never your DATABASE_URL)')
+    return parser.parse_args()
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def main():
+    args = parse_args()
+    db_file = None
+    if not args.database_url:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+        args.database_url = f'sqlite:///{db_file}'
+    # Point the app at the load-test database before importing it
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ['VERCEL'] = '1'  # skip init_database() and grading workers on import
+    os.environ.setdefault('GRADING_WORKERS', '0')
+    os.environ.setdefault('EXAM_LOBBY_WORKERS', '1')
+
+    import json
+    from app import app, db, run_schema_migrations, User, Quiz, QuizQuestion, QuizSubmission
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        # drop_all() below wipes the database, so refuse to run anywhere but the requested one
+        engine_url = db.engine.url.render_as_string(hide_password=False)
+        if engine_url != args.database_url:
+            sys.exit(f"Refusing to run: the app opened {engine_url}, not {args.database_url} "
+                     "(use an absolute sqlite:////path or a postgresql:// URL)")
+        db.drop_all()
+        db.create_all()
+        run_schema_migrations()
+        users = [{'id': 1, 'username': 'teacher', 'email': 'teacher@example.com', 'password_hash': 'x', 'role': 'teacher'}]
+        users += [{'id': i + 2, 'username': f'student{i}', 'email': f'student{i}@example.com', 'password_hash': 'x',
+                   'role': 'student'} for i in range(args.students)]
+        db.session.execute(db.insert(User), users)
+        for quiz_id, code in ((1, 'DIRECT'), (2, 'EXAM01')):
+            db.session.add(Quiz(id=quiz_id, title=f'Load test {code}', code=code, created_by=1))
+            db.session.flush()
+            db.session.execute(db.insert(QuizQuestion), [
+                {'quiz_id': quiz_id, 'question': f'Question {n}?', 'qtype': 'mcq', 'marks': 1, 'answer': 'A',
+                 'options_json': json.dumps(['A. yes', 'B. no', 'C. maybe', 'D. never'])}
+                for n in range(args.questions)])
+        db.session.commit()
+        student_ids = [user['id'] for user in users[1:]]
+
+    def client_for(user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(user_id)
+            sess['_fresh'] = True
+        return client
+
+    def run_round(code, exam_mode):
+        timings = defaultdict(list)
+        errors = defaultdict(int)
+        clients = [client_for(user_id) for user_id in student_ids]
+        barrier = threading.Barrier(len(clients))
+
+        def timed(name, call, expect):
+            started = time.perf_counter()
+            try:
+                response = call()
+            except Exception as e:
+                errors[f'{name}: {type(e).__name__}'] += 1
+                return None
+            timings[name].append((time.perf_counter() - started) * 1000)
+            if response.status_code not in expect:
+                errors[f'{name}: HTTP {response.status_code}'] += 1
+            return response
+
+        def student(client):
+            barrier.wait()
+            timed('join', lambda: client.post('/quiz/join', data={'code': code}), (302,))
+            if exam_mode:
+                timed('lobby', lambda: client.get(f'/quiz/lobby/{code}'), (200, 302))
+                while True:
+                    response = timed('lobby status', lambda: client.get(f'/quiz/lobby/{code}/status'), (200,))
+                    if response is None:
+                        return
+                    data = response.get_json()
+                    if data.get('admitted'):
+                        break
+                    time.sleep(max(0.05, data.get('wait_seconds', 1)))
+            timed('take', lambda: client.get(f'/quiz/take/{code}'), (200,))
+
+        if exam_mode:
+            teacher = client_for(1)
+            response = teacher.post(f'/teacher/quiz/{code}/exam/start', data={
+                'admit_per_minute': str(args.admit_per_minute)})
+            assert response.status_code == 302, response.status_code
+
+        threads = [threading.Thread(target=student, args=(client,)) for client in clients]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        with app.app_context():
+            quiz_id = db.session.query(Quiz.id).filter_by(code=code).scalar()
+            submissions = db.session.query(QuizSubmission).filter_by(quiz_id=quiz_id).count()
+        label = 'exam mode' if exam_mode else 'direct'
+        print(f"\n{label}: {len(clients)} students in {elapsed:.1f}s, {submissions} submission rows")
+        print(f"  {'page':<14} {'requests':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for name, values in timings.items():
+            print(f"  {name:<14} {len(values):>8} {statistics.median(values):>9.1f} {percentile(values, 95):>9.1f} "
+                  f"{percentile(values, 99):>9.1f} {max(values):>9.1f}")
+        for error, count in sorted(errors.items()):
+            print(f"  error {error}: {count}")
+
+    print(f"Database: {args.database_url.split('@')[-1]}, {args.students} students, {args.questions} questions")
+    run_round('DIRECT', exam_mode=False)
+    run_round('EXAM01', exam_mode=True)
+
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+    if db_file:
+        os.unlink(db_file)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,7 +9,7 @@ Run this script to add all required columns for:
 Usage: python migrate_new_features.py
 """
 
-from app import app, db
+from app import app, db, run_schema_migrations
 from sqlalchemy import text
 
 def migrate_database():
@@ -188,7 +188,20 @@ def migrate_database():
                 else:
                     print(f"  ❌ Error: {e}")
             
+            try:
+                conn.execute(text("ALTER TABLE quiz_submission ADD COLUMN grading_status VARCHAR(20) DEFAULT 'graded';"))
+                print("  ✅ Added grading_status")
+            except Exception as e:
+                if "duplicate column" in str(e).lower() or "already exists" in str(e).lower():
+                    print("  ⚠️  grading_status already exists")
+                else:
+                    print(f"  ❌ Error: {e}")
+            
             trans.commit()
+            # Create new tables (grading_job, quiz_attempt, ...)
+            db.create_all()
+            # Versioned migrations (indexes, unique constraints)
+            run_schema_migrations()
             print("\n✅ Migration completed successfully!")
             print("\nNext steps:")
             print("1. Update your app.py with the new model fields")